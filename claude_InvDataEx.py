@@ -5,8 +5,11 @@ import traceback
 import time
 import signal
 import sys
+import itertools
 import logging
-from logging.handlers import RotatingFileHandler
+import multiprocessing
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 import pdfplumber
 import shutil
@@ -37,21 +40,27 @@ log_level_str = os.getenv('LOGGING_LEVEL', 'INFO').upper()
 # Get the corresponding logging constant, default to INFO if invalid
 log_level = LOGGING_LEVEL_MAP.get(log_level_str, logging.INFO)
 
-file_handler = RotatingFileHandler(
-    LOG_FILE,
-    maxBytes=LOG_MAX_BYTES,
-    backupCount=LOG_BACKUP_COUNT,
-    encoding='utf-8' # Added encoding
-)
-file_handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
-
-console_handler = logging.StreamHandler(sys.stdout)
-console_handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
-
-logging.basicConfig(
-    level=log_level, # Use level from .env
-    handlers=[file_handler, console_handler]
-)
+def setup_logging():
+    """
+    Attach the rotating file and console handlers. Called only from __main__: extraction
+    worker processes re-import this module (spawn on Windows) and must not open or rotate
+    the shared log file; they send their records to the main process instead.
+    """
+    file_handler = RotatingFileHandler(
+        LOG_FILE,
+        maxBytes=LOG_MAX_BYTES,
+        backupCount=LOG_BACKUP_COUNT,
+        encoding='utf-8' # Added encoding
+    )
+    file_handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
+
+    console_handler = logging.StreamHandler(sys.stdout)
+    console_handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
+
+    logging.basicConfig(
+        level=log_level, # Use level from .env
+        handlers=[file_handler, console_handler]
+    )
 
 # === CONFIGURATION ===
 # Read directory paths from environment variables with defaults
@@ -59,18 +68,117 @@ INPUT_DIR = os.getenv('INPUT_DIR', 'files/input')
 ARCHIVE_DIR = os.getenv('ARCHIVE_DIR', 'files/archive')
 ERROR_DIR = os.getenv('ERROR_DIR', 'files/error')
 OUTPUT_DIR = os.getenv('OUTPUT_DIR', 'files/output')
+# Worker processes for the PDFs already waiting at startup (text extraction is CPU-bound)
+EXTRACT_WORKERS = int(os.getenv('EXTRACT_WORKERS', os.cpu_count() or 1))
+
+# Per-process counter appended to moved file names so two files moved within
+# the same second still get unique names
+_move_counter = itertools.count()
+
+# === PRECOMPILED PATTERNS ===
+# Used for every line of every item table, so compiled once here instead of looked up per call
+INVOICE_NO_RE = re.compile(r'(SC\d{5}-\d{2}-\d{2})')
+ITEM_TABLE_HEADER_RE = re.compile(r'Sl\s+Description')
+ITEM_TABLE_HEADER_ALT_RE = re.compile(r'No\.\s+Goods and Services')
+ITEM_NO_RE = re.compile(r'^(\d+)\s+')
+HSN_AT_END_RE = re.compile(r'(\d{6,8})$')
+HSN_RE = re.compile(r'\b\d{6,8}\b')
+QTY_NOS_RE = re.compile(r'(\d+)\s+NOS')
+DECIMAL_RE = re.compile(r'([\d,.]+\.\d{2})')
+TAX_LINE_RE = re.compile(r'(Output\s+)?(CGST|SGST|IGST)', re.IGNORECASE)
+TOTAL_WORD_RE = re.compile(r'\bTotal\b', re.IGNORECASE)
+EDGE_NON_DIGITS_RE = re.compile(r'^[^\d]+|[^\d]+$')
+AMOUNT_RE = re.compile(r'[\d,.]+\.\d{2}')
+NOS_WORD_RE = re.compile(r'\bNOS\b', re.IGNORECASE)
+TAX_INFO_RES = [re.compile(rf'Output\s+{tax}\s*[-\d.% ]+', re.IGNORECASE) for tax in ('IGST', 'CGST', 'SGST')]
+WHITESPACE_RE = re.compile(r'\s+')
+PHONE_RES = [
+    re.compile(r'(?:Phone|Ph|Tel|T|Contact|Mobile|Mob)[:\s.\-]+(\+?\d[\d\s\-]{8,})', re.IGNORECASE),
+    re.compile(r'(?<!\S)(\+?\d{10,12})(?!\S)', re.IGNORECASE),  # Standalone 10-12 digit number
+    re.compile(r'(?<!\S)(\d{3,5}[\s\-]\d{6,8})(?!\S)', re.IGNORECASE)  # Format like 022-12345678
+]
+EMAIL_RE = re.compile(r'[a-zA-Z0-9._%+\-]+@[a-zA-Z0-9.\-]+\.[a-zA-Z]{2,}')
+GSTIN_RE = re.compile(r'GSTIN/UIN\s*:\s*([A-Z0-9]+)')
+STATE_NAME_RE = re.compile(r'State Name\s*:\s*([^,]+)')
+
+# === PARTY (CONSIGNEE/BUYER) DETAILS ===
+def extract_party_details(lines, start, end, header_data, prefix):
+    """
+    Fill the <prefix>_name/address/contact/email/gstin/state fields of header_data
+    from the party block lines[start:end]
+    """
+    # Extract name (should be first line after the section title)
+    header_data[f'{prefix}_name'] = lines[start].strip()
+    
+    # Extract address (lines between name and GSTIN)
+    address_lines = []
+    full_text = ""  # For searching contact and email
+    
+    for idx in range(start + 1, end):
+        line = lines[idx].strip()
+        if 'GSTIN/UIN' in line:
+            break
+        address_lines.append(line)
+        full_text += line + " "
+    
+    header_data[f'{prefix}_address'] = ", ".join(address_lines)
+    
+    # Extract contact number
+    for pattern in PHONE_RES:
+        phone_match = pattern.search(full_text)
+        if phone_match:
+            header_data[f'{prefix}_contact'] = phone_match.group(1).strip()
+            # Remove contact from address
+            header_data[f'{prefix}_address'] = pattern.sub('', header_data[f'{prefix}_address'])
+            break
+    
+    # Extract email
+    email_match = EMAIL_RE.search(full_text)
+    if email_match:
+        header_data[f'{prefix}_email'] = email_match.group(0).strip()
+        # Remove email from address
+        header_data[f'{prefix}_address'] = header_data[f'{prefix}_address'].replace(header_data[f'{prefix}_email'], '')
+    
+    # Extract GSTIN and State
+    for idx in range(start, end):
+        line = lines[idx].strip()
+        if 'GSTIN/UIN' in line:
+            gstin_match = GSTIN_RE.search(line)
+            if gstin_match:
+                header_data[f'{prefix}_gstin'] = gstin_match.group(1)
+        if 'State Name' in line:
+            state_match = STATE_NAME_RE.search(line)
+            if state_match:
+                header_data[f'{prefix}_state'] = state_match.group(1).strip()
+
+# === PDF TEXT EXTRACTION ===
+def extract_page_texts(file_path):
+    """
+    Open the PDF once and return the text of every page, in order. Each page is released
+    after its text is extracted, so only one page's parsed objects are held at a time.
+    """
+    page_texts = []
+    with pdfplumber.open(file_path) as pdf:
+        for page in pdf.pages:
+            page_texts.append(page.extract_text())
+            page.close()
+    return page_texts
 
 # === PDF HEADER EXTRACTION FUNCTION ===
-def extract_header_from_pdf(file_path):
+def extract_header_from_pdf(file_path, page_texts=None):
     """
-    Extract header information from PDF invoice and return as dictionary
+    Extract header information from PDF invoice and return as dictionary.
+    page_texts: text of every page, if already extracted (see extract_page_texts)
     """
     file_name = os.path.basename(file_path)
     
-    with pdfplumber.open(file_path) as pdf:
-        # We only process the first page for header information
-        text = pdf.pages[0].extract_text()
-        lines = text.splitlines()
+    if page_texts is None:
+        with pdfplumber.open(file_path) as pdf:
+            # We only process the first page for header information
+            text = pdf.pages[0].extract_text()
+    else:
+        text = page_texts[0]
+    lines = text.splitlines()
     
     # === Preprocess lines: fix merged E-Way Bill No + Date like 12345678901225-Mar-24 ===
     fixed_lines = []
@@ -78,7 +186,7 @@ def extract_header_from_pdf(file_path):
         merged_match = re.search(r'(\d{12})(\d{1,2}-[A-Za-z]{3}-\d{2})', line)
         if merged_match:
             fixed_line = line.replace(merged_match.group(0), f"{merged_match.group(1)} {merged_match.group(2)}")
-            logging.debug(f"[Fix] Merged EWB+Date: {line} → {fixed_line}")
+            logging.debug("[Fix] Merged EWB+Date: %s → %s", line, fixed_line)
             fixed_lines.append(fixed_line)
         else:
             fixed_lines.append(line)
@@ -122,7 +230,7 @@ def extract_header_from_pdf(file_path):
             date_match = re.search(r'(\d{1,2}-[A-Za-z]{3}-\d{2})', lines[i])
             if date_match and 'Ack Date' not in lines[i]:
                 header_data['invoice_date'] = date_match.group(1)
-                logging.debug(f"Found date near invoice number: {header_data['invoice_date']}")
+                logging.debug("Found date near invoice number: %s", header_data['invoice_date'])
                 break
     
     # If date not found near invoice, try other approaches
@@ -133,7 +241,7 @@ def extract_header_from_pdf(file_path):
                 date_match = re.search(r'Dated\s+(\d{1,2}-[A-Za-z]{3}-\d{2})', line)
                 if date_match:
                     header_data['invoice_date'] = date_match.group(1)
-                    logging.debug(f"Found date via 'Dated' pattern: {header_data['invoice_date']}")
+                    logging.debug("Found date via 'Dated' pattern: %s", header_data['invoice_date'])
                     break
     
     # Special Case: Handle merged E-Way Bill No + Date (e.g., "12345678901225-Mar-24")
@@ -142,7 +250,7 @@ def extract_header_from_pdf(file_path):
             merged_match = re.search(r'(\d{12})(\d{1,2}-[A-Za-z]{3}-\d{2})', line)
             if merged_match:
                 eway_no, date_str = merged_match.groups()
-                logging.debug(f"Detected merged E-Way Bill and Date: {eway_no} + {date_str}")
+                logging.debug("Detected merged E-Way Bill and Date: %s + %s", eway_no, date_str)
                 header_data['invoice_date'] = date_str
                 break
 
@@ -154,7 +262,7 @@ def extract_header_from_pdf(file_path):
             merged_match = re.search(r'(\d{12})(\d{1,2}-[A-Za-z]{3}-\d{2})', line)
             if merged_match:
                 fixed_line = line.replace(merged_match.group(0), f"{merged_match.group(1)} {merged_match.group(2)}")
-                logging.debug(f"Fixed merged line: {line} -> {fixed_line}")
+                logging.debug("Fixed merged line: %s -> %s", line, fixed_line)
                 cleaned_lines.append(fixed_line)
             else:
                 cleaned_lines.append(line)
@@ -166,7 +274,7 @@ def extract_header_from_pdf(file_path):
             date_match = re.search(r'\b(\d{1,2}-[A-Za-z]{3}-\d{2})\b', line)
             if date_match and 'Ack Date' not in line:
                 header_data['invoice_date'] = date_match.group(1).strip()
-                logging.debug(f"Found date after cleaning merged E-Way Bill: {header_data['invoice_date']}")
+                logging.debug("Found date after cleaning merged E-Way Bill: %s", header_data['invoice_date'])
                 break
     
     # Approach 3: Look specifically near bill of lading
@@ -178,7 +286,7 @@ def extract_header_from_pdf(file_path):
                     date_match = re.search(r'(\d{1,2}-[A-Za-z]{3}-\d{2})', lines[i])
                     if date_match:
                         header_data['invoice_date'] = date_match.group(1)
-                        logging.debug(f"Found date near bill of lading: {header_data['invoice_date']}")
+                        logging.debug("Found date near bill of lading: %s", header_data['invoice_date'])
                         break
                 if header_data['invoice_date']:
                     break
@@ -193,7 +301,7 @@ def extract_header_from_pdf(file_path):
             if dest_match:
                 header_data['destination'] = dest_match.group(1).strip()
                 destination_found = True
-                logging.debug(f"Found destination via pattern 1: {header_data['destination']}")
+                logging.debug("Found destination via pattern 1: %s", header_data['destination'])
                 break
     
     # Method 2: Look for "Destination" word and extract the next part
@@ -211,7 +319,7 @@ def extract_header_from_pdf(file_path):
                             header_data['destination'] = header_data['destination'].split(stop_point)[0].strip()
                     
                     destination_found = True
-                    logging.debug(f"Found destination via pattern 2: {header_data['destination']}")
+                    logging.debug("Found destination via pattern 2: %s", header_data['destination'])
                     break
                 
                 # If not on same line, check the next line
@@ -226,7 +334,7 @@ def extract_header_from_pdf(file_path):
                                 header_data['destination'] = header_data['destination'].split(stop_point)[0].strip()
                         
                         destination_found = True
-                        logging.debug(f"Found destination via pattern 3: {header_data['destination']}")
+                        logging.debug("Found destination via pattern 3: %s", header_data['destination'])
                         break
     
     # Method 3: Look specifically between "Destination" and "Motor Vehicle"
@@ -250,14 +358,14 @@ def extract_header_from_pdf(file_path):
                         if parts:
                             header_data['destination'] = parts.strip(':').strip()
                             destination_found = True
-                            logging.debug(f"Found destination via pattern 4: {header_data['destination']}")
+                            logging.debug("Found destination via pattern 4: %s", header_data['destination'])
                     else:
                         # Destination and Motor Vehicle on different lines
                         dest_text = lines[dest_idx].split('Destination')[1].strip(':').strip()
                         if dest_text:
                             header_data['destination'] = dest_text
                             destination_found = True
-                            logging.debug(f"Found destination via pattern 5: {header_data['destination']}")
+                            logging.debug("Found destination via pattern 5: %s", header_data['destination'])
     
     # Method 4: Look for common destination patterns like "Destination: Mumbai"
     if not destination_found:
@@ -266,7 +374,7 @@ def extract_header_from_pdf(file_path):
             if dest_pattern:
                 header_data['destination'] = dest_pattern.group(1).strip()
                 destination_found = True
-                logging.debug(f"Found destination via pattern 6: {header_data['destination']}")
+                logging.debug("Found destination via pattern 6: %s", header_data['destination'])
                 break
     
     # Find place of supply
@@ -294,109 +402,11 @@ def extract_header_from_pdf(file_path):
             buyer_end = idx
             break
     
-    # Extract Consignee information
+    # Extract Consignee and Buyer information (same block layout, different field prefix)
     if consignee_start and consignee_end:
-        # Extract name (should be first line after "Consignee (Ship to)")
-        header_data['consignee_name'] = lines[consignee_start].strip()
-        
-        # Extract address (lines between name and GSTIN)
-        address_lines = []
-        consignee_full_text = ""  # For searching contact and email
-        
-        for idx in range(consignee_start + 1, consignee_end):
-            line = lines[idx].strip()
-            if 'GSTIN/UIN' in line:
-                break
-            address_lines.append(line)
-            consignee_full_text += line + " "
-        
-        header_data['consignee_address'] = ", ".join(address_lines)
-        
-        # Extract contact number
-        phone_patterns = [
-            r'(?:Phone|Ph|Tel|T|Contact|Mobile|Mob)[:\s.\-]+(\+?\d[\d\s\-]{8,})',
-            r'(?<!\S)(\+?\d{10,12})(?!\S)',  # Standalone 10-12 digit number
-            r'(?<!\S)(\d{3,5}[\s\-]\d{6,8})(?!\S)'  # Format like 022-12345678
-        ]
-        
-        for pattern in phone_patterns:
-            phone_match = re.search(pattern, consignee_full_text, re.IGNORECASE)
-            if phone_match:
-                header_data['consignee_contact'] = phone_match.group(1).strip()
-                # Remove contact from address
-                header_data['consignee_address'] = re.sub(pattern, '', header_data['consignee_address'], flags=re.IGNORECASE)
-                break
-        
-        # Extract email
-        email_match = re.search(r'[a-zA-Z0-9._%+\-]+@[a-zA-Z0-9.\-]+\.[a-zA-Z]{2,}', consignee_full_text)
-        if email_match:
-            header_data['consignee_email'] = email_match.group(0).strip()
-            # Remove email from address
-            header_data['consignee_address'] = header_data['consignee_address'].replace(header_data['consignee_email'], '')
-        
-        # Extract GSTIN and State
-        for idx in range(consignee_start, consignee_end):
-            line = lines[idx].strip()
-            if 'GSTIN/UIN' in line:
-                gstin_match = re.search(r'GSTIN/UIN\s*:\s*([A-Z0-9]+)', line)
-                if gstin_match:
-                    header_data['consignee_gstin'] = gstin_match.group(1)
-            if 'State Name' in line:
-                state_match = re.search(r'State Name\s*:\s*([^,]+)', line)
-                if state_match:
-                    header_data['consignee_state'] = state_match.group(1).strip()
-    
-    # Extract Buyer information
+        extract_party_details(lines, consignee_start, consignee_end, header_data, 'consignee')
     if buyer_start and buyer_end:
-        # Extract name (should be first line after "Buyer (Bill to)")
-        header_data['buyer_name'] = lines[buyer_start].strip()
-        
-        # Extract address (lines between name and GSTIN)
-        address_lines = []
-        buyer_full_text = ""  # For searching contact and email
-        
-        for idx in range(buyer_start + 1, buyer_end):
-            line = lines[idx].strip()
-            if 'GSTIN/UIN' in line:
-                break
-            address_lines.append(line)
-            buyer_full_text += line + " "
-        
-        header_data['buyer_address'] = ", ".join(address_lines)
-        
-        # Extract contact number
-        phone_patterns = [
-            r'(?:Phone|Ph|Tel|T|Contact|Mobile|Mob)[:\s.\-]+(\+?\d[\d\s\-]{8,})',
-            r'(?<!\S)(\+?\d{10,12})(?!\S)',  # Standalone 10-12 digit number
-            r'(?<!\S)(\d{3,5}[\s\-]\d{6,8})(?!\S)'  # Format like 022-12345678
-        ]
-        
-        for pattern in phone_patterns:
-            phone_match = re.search(pattern, buyer_full_text, re.IGNORECASE)
-            if phone_match:
-                header_data['buyer_contact'] = phone_match.group(1).strip()
-                # Remove contact from address
-                header_data['buyer_address'] = re.sub(pattern, '', header_data['buyer_address'], flags=re.IGNORECASE)
-                break
-        
-        # Extract email
-        email_match = re.search(r'[a-zA-Z0-9._%+\-]+@[a-zA-Z0-9.\-]+\.[a-zA-Z]{2,}', buyer_full_text)
-        if email_match:
-            header_data['buyer_email'] = email_match.group(0).strip()
-            # Remove email from address  
-            header_data['buyer_address'] = header_data['buyer_address'].replace(header_data['buyer_email'], '')
-        
-        # Extract GSTIN and State
-        for idx in range(buyer_start, buyer_end):
-            line = lines[idx].strip()
-            if 'GSTIN/UIN' in line:
-                gstin_match = re.search(r'GSTIN/UIN\s*:\s*([A-Z0-9]+)', line)
-                if gstin_match:
-                    header_data['buyer_gstin'] = gstin_match.group(1)
-            if 'State Name' in line:
-                state_match = re.search(r'State Name\s*:\s*([^,]+)', line)
-                if state_match:
-                    header_data['buyer_state'] = state_match.group(1).strip()
+        extract_party_details(lines, buyer_start, buyer_end, header_data, 'buyer')
     
     # Clean up any extra data in fields
     # Sometimes PDFs have layout issues that cause text to merge across columns
@@ -419,288 +429,288 @@ def extract_header_from_pdf(file_path):
                 header_data[key] = re.sub(r'\s*,\s*,\s*', ', ', header_data[key])
                 header_data[key] = re.sub(r'\s*,\s*$', '', header_data[key])
     
-    # Debug output
-    logging.debug("\n--- Extracted Header Data ---")
-    for key, value in header_data.items():
-        logging.debug(f"{key}: {value}")
-    logging.debug("----------------------------\n")
+    # Debug output - built only when DEBUG is on, and logged as one record instead of one per field
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        dump = "\n".join(f"{key}: {value}" for key, value in header_data.items())
+        logging.debug("\n--- Extracted Header Data ---\n%s\n----------------------------\n", dump)
     
     return header_data
 
 # === ITEM DETAILS EXTRACTION FUNCTION - MODIFIED ===
-def extract_items_from_pdf(file_path):
+def extract_items_from_pdf(file_path, page_texts=None):
     """
-    Extract item details from PDF invoice and return as a list of dictionaries
+    Extract item details from PDF invoice and return as a list of dictionaries.
+    page_texts: text of every page, if already extracted (see extract_page_texts)
     """
     file_name = os.path.basename(file_path)
     invoice_number = ""
     items = []
     processed_item_numbers = set()  # Track already processed item numbers
     
-    with pdfplumber.open(file_path) as pdf:
-        # First, get the invoice number from the first page
-        first_page_text = pdf.pages[0].extract_text()
-        first_page_lines = first_page_text.splitlines()
+    if page_texts is None:
+        page_texts = extract_page_texts(file_path)
+
+    # First, get the invoice number from the first page
+    first_page_lines = page_texts[0].splitlines()
+    
+    for line in first_page_lines:
+        if 'SC' in line:
+            match = INVOICE_NO_RE.search(line)
+            if match:
+                invoice_number = match.group(1)
+                break
+    
+    # Now process each page separately to avoid duplicates
+    for page_num, page_text in enumerate(page_texts):
+        lines = page_text.splitlines()
         
-        for line in first_page_lines:
-            if 'SC' in line and re.search(r'SC\d{5}-\d{2}-\d{2}', line):
-                match = re.search(r'(SC\d{5}-\d{2}-\d{2})', line)
-                if match:
-                    invoice_number = match.group(1)
-                    break
+        logging.debug("\nProcessing page %s", page_num + 1)
         
-        # Now process each page separately to avoid duplicates
-        for page_num, page in enumerate(pdf.pages):
-            page_text = page.extract_text()
-            lines = page_text.splitlines()
-            
-            logging.debug(f"\nProcessing page {page_num + 1}")
-            
-            # Find the start and end of item table for this page
-            item_start_idx = None
-            item_end_idx = None
-            
-            for idx, line in enumerate(lines):
-                # Look for table headers
-                if (re.search(r'Sl\s+Description', line) and 
-                    ('Quantity' in line or 'HSN/SAC' in line)) or \
-                   (re.search(r'No\.\s+Goods and Services', line)):
-                    item_start_idx = idx + 1
+        # Find the start and end of item table for this page
+        item_start_idx = None
+        item_end_idx = None
+        
+        for idx, line in enumerate(lines):
+            # Look for table headers
+            if (ITEM_TABLE_HEADER_RE.search(line) and 
+                ('Quantity' in line or 'HSN/SAC' in line)) or \
+               (ITEM_TABLE_HEADER_ALT_RE.search(line)):
+                item_start_idx = idx + 1
+                break
+        
+        if item_start_idx:
+            # Look for end markers
+            for idx in range(item_start_idx, len(lines)):
+                if ("Amount Chargeable" in lines[idx] or 
+                    "Total" in lines[idx] or 
+                    "continued to page" in lines[idx] or
+                    "SUBJECT TO" in lines[idx]):
+                    item_end_idx = idx
                     break
             
-            if item_start_idx:
-                # Look for end markers
-                for idx in range(item_start_idx, len(lines)):
-                    if ("Amount Chargeable" in lines[idx] or 
-                        "Total" in lines[idx] or 
-                        "continued to page" in lines[idx] or
-                        "SUBJECT TO" in lines[idx]):
-                        item_end_idx = idx
-                        break
+            # If no end marker found, process until end of page
+            if not item_end_idx:
+                item_end_idx = len(lines)
+            
+            # Process item lines for this page
+            idx = item_start_idx
+            while idx < item_end_idx:
+                line = lines[idx].strip()
                 
-                # If no end marker found, process until end of page
-                if not item_end_idx:
-                    item_end_idx = len(lines)
+                # Skip empty lines or table headers
+                if not line or line.startswith("Sl") or line.startswith("No."):
+                    idx += 1
+                    continue
                 
-                # Process item lines for this page
-                idx = item_start_idx
-                while idx < item_end_idx:
-                    line = lines[idx].strip()
-                    
-                    # Skip empty lines or table headers
-                    if not line or line.startswith("Sl") or line.startswith("No."):
-                        idx += 1
-                        continue
-                    
-                    # Check if line starts with a number (potential item number)
-                    item_num_match = re.match(r'^(\d+)\s+', line)
-                    if not item_num_match:
-                        idx += 1
-                        continue
-                    
-                    item_no = item_num_match.group(1).strip()
-                    
-                    # Skip if we've already processed this item number
-                    if item_no in processed_item_numbers:
-                        idx += 1
+                # Check if line starts with a number (potential item number)
+                item_num_match = ITEM_NO_RE.match(line)
+                if not item_num_match:
+                    idx += 1
+                    continue
+                
+                item_no = item_num_match.group(1).strip()
+                
+                # Skip if we've already processed this item number
+                if item_no in processed_item_numbers:
+                    idx += 1
+                    continue
+                
+                # Log for debugging
+                logging.debug("Processing potential item line: %s", line)
+
+                # --- Initial analysis of the main line ---
+                main_line_hsn_match = HSN_AT_END_RE.search(line) # HSN at end
+                main_line_qty_match = QTY_NOS_RE.search(line) # Assuming NOS unit for now
+                main_line_decimals = DECIMAL_RE.findall(line)
+                is_service_item = not main_line_qty_match # Tentative: service if no qty on main line
+
+                # Start building the description from the main line
+                description_lines = []
+                if item_num_match:
+                    initial_description = line[len(item_num_match.group(0)):].strip()
+                    description_lines.append(initial_description)
+
+                # --- Look ahead for additional description lines ---
+                next_idx = idx + 1
+                while next_idx < item_end_idx:
+                    next_line = lines[next_idx].strip()
+
+                    # Break if we find an end marker
+                    if ("Amount Chargeable" in next_line or
+                        "Total" in next_line or
+                        "continued to page" in next_line or
+                        "SUBJECT TO" in next_line):
+                        break
+
+                    # Skip empty lines
+                    if not next_line:
+                        next_idx += 1
                         continue
-                    
-                    # Log for debugging
-                    logging.debug(f"Processing potential item line: {line}")
-
-                    # --- Initial analysis of the main line ---
-                    main_line_hsn_match = re.search(r'(\d{6,8})$', line) # HSN at end
-                    main_line_qty_match = re.search(r'(\d+)\s+NOS', line) # Assuming NOS unit for now
-                    main_line_decimals = re.findall(r'([\d,.]+\.\d{2})', line)
-                    is_service_item = not main_line_qty_match # Tentative: service if no qty on main line
-
-                    # Start building the description from the main line
-                    description_lines = []
-                    if item_num_match:
-                        initial_description = line[len(item_num_match.group(0)):].strip()
-                        description_lines.append(initial_description)
-
-                    # --- Look ahead for additional description lines ---
-                    next_idx = idx + 1
-                    while next_idx < item_end_idx:
-                        next_line = lines[next_idx].strip()
-
-                        # Break if we find an end marker
-                        if ("Amount Chargeable" in next_line or
-                            "Total" in next_line or
-                            "continued to page" in next_line or
-                            "SUBJECT TO" in next_line):
-                            break
-
-                        # Skip empty lines
-                        if not next_line:
-                            next_idx += 1
-                            continue
-
-                        # Check if the next line starts with a number
-                        next_item_num_match = re.match(r'^\d+\s+', next_line)
-
-                        is_likely_new_item = False
-                        if next_item_num_match:
-                            # Check if this line looks like a *new* item line
-                            next_line_hsn = re.search(r'\b\d{6,8}\b', next_line) # HSN anywhere
-                            next_line_qty = re.search(r'\d+\s+NOS', next_line) # Qty anywhere
-                            next_line_decimals = re.findall(r'([\d,.]+\.\d{2})', next_line)
-
-                            # Conditions for being a new item line:
-                            # 1. Has HSN?
-                            # 2. Has Qty?
-                            # 3. Has at least two decimal numbers (likely rate/amount)?
-                            if next_line_hsn or next_line_qty or len(next_line_decimals) >= 2:
-                                is_likely_new_item = True
-                                # Optional: Add check for sequential item number?
-                                # try:
-                                #     if int(next_item_num_match.group(1)) > int(item_no):
-                                #         is_likely_new_item = True
-                                # except ValueError:
-                                #     pass # Ignore if conversion fails
-
-                        if is_likely_new_item:
-                            logging.debug(f"Detected likely new item line: {next_line}. Stopping description.")
-                            break # Stop accumulating description, it's a new item
-                        else:
-                            # --- ADDED TAX AND TOTAL LINE CHECKS ---
-                            # Check 1: Does the line look like a tax line (CGST, SGST, IGST)?
-                            is_tax_line = re.search(r'(Output\s+)?(CGST|SGST|IGST)', next_line, re.IGNORECASE)
-
-                            # Check 2: Does the line look like *only* a total amount?
-                            # Heuristic: Remove "Total" keyword (case-insensitive) and surrounding whitespace.
-                            # Check if the *entire remaining string* is just a decimal number.
-                            potential_total_text = re.sub(r'\bTotal\b', '', next_line, flags=re.IGNORECASE).strip()
-                            # Allow for optional currency symbols or leading/trailing punctuation sometimes seen near totals
-                            potential_total_text = re.sub(r'^[^\d]+|[^\d]+$', '', potential_total_text).strip() 
-                            is_likely_total_line = re.fullmatch(r'[\d,.]+\.\d{2}', potential_total_text)
-
-                            if is_tax_line:
-                                logging.debug(f"Detected tax line: {next_line}. Stopping description.")
-                                break # Stop accumulating description before adding tax line
-                            elif is_likely_total_line:
-                                 logging.debug(f"Detected likely total line: {next_line}. Stopping description.")
-                                 break # Stop accumulating description before adding total line
-                            # --- END TAX AND TOTAL LINE CHECKS ---
-
-                            # This is a continuation line (passes all checks)
-                            logging.debug(f"Adding description line: {next_line}")
-                            description_lines.append(next_line)
-                            next_idx += 1
-
-                    # --- After the inner while loop ---
-
-                    # Join all description lines
-                    full_description = ' '.join(description_lines)
-
-                    # --- Perform cleaning on full_description ---
-                    # Use the HSN/Qty/Decimals found on the *main line* for final assignment and cleaning
-
-                    # Extract final values from main line analysis
-                    hsn = main_line_hsn_match.group(1) if main_line_hsn_match else ""
-                    qty_value = main_line_qty_match.group(1) if main_line_qty_match else ""
-                    qty_unit = "NOS" if main_line_qty_match else ""
-
-                    # Remove HSN code from description
-                    if hsn:
-                        full_description = re.sub(rf'\b{hsn}\b', '', full_description)
-                    # Also remove any other HSN-like numbers that might be in description text
-                    full_description = re.sub(r'\b\d{6,8}\b', '', full_description)
-
-                    # Remove Unit from description
-                    if qty_unit:
-                        full_description = re.sub(r'\bNOS\b', '', full_description, flags=re.IGNORECASE)
-
-                    # Remove rate and amount values (using decimals found on main line) from description
-                    for value in main_line_decimals:
-                        # Use regex to avoid replacing parts of other numbers
-                        full_description = re.sub(rf'(?<![\d.,]){re.escape(value)}(?![\d.,])', '', full_description)
-
-                    # Remove quantity value from description
-                    if qty_value:
-                        full_description = re.sub(rf'\b{qty_value}\b', '', full_description)
-
-                    # --- START TAX INFO REMOVAL ---
-                    full_description = re.sub(r'Output\s+IGST\s*[-\d.% ]+', '', full_description, flags=re.IGNORECASE)
-                    full_description = re.sub(r'Output\s+CGST\s*[-\d.% ]+', '', full_description, flags=re.IGNORECASE)
-                    full_description = re.sub(r'Output\s+SGST\s*[-\d.% ]+', '', full_description, flags=re.IGNORECASE)
-                    # --- END TAX INFO REMOVAL ---
-
-                    # Clean up extra spaces
-                    full_description = re.sub(r'\s+', ' ', full_description).strip()
-
-                    # --- Assign final rate and amount based on main line analysis ---
-                    rate = ""
-                    amount = ""
-
-                    if not qty_value: # Treat as service item if no qty on main line
-                        if len(main_line_decimals) >= 1:
-                            # Assume amount is the last decimal on the line for service items
-                            amount = main_line_decimals[-1]
-                            rate = ""
-                    else: # Treat as regular item
-                        if len(main_line_decimals) >= 2:
-                            # Assuming Rate is first, Amount is second on the main line for product items
-                            # (Adjust if this assumption is wrong for your PDFs)
-                            rate = main_line_decimals[0]
-                            amount = main_line_decimals[1]
-                        elif len(main_line_decimals) == 1:
-                            # If only one number for product, assume it's amount
-                            amount = main_line_decimals[0]
-                            rate = ""
-                    
-                    # Get the first line for the 'Item' field
-                    first_line_item = description_lines[0].strip() if description_lines else ''
-                    # Clean the first line similar to how full_description is cleaned (remove HSN, Qty, Rate, Amount, Tax)
-                    if hsn:
-                        first_line_item = re.sub(rf'\b{hsn}\b', '', first_line_item)
-                    first_line_item = re.sub(r'\b\d{6,8}\b', '', first_line_item) # Remove other HSN-like
-                    if qty_unit:
-                        first_line_item = re.sub(r'\bNOS\b', '', first_line_item, flags=re.IGNORECASE)
-                    for value in main_line_decimals:
-                         first_line_item = re.sub(rf'(?<![\d.,]){re.escape(value)}(?![\d.,])', '', first_line_item)
-                    if qty_value:
-                        first_line_item = re.sub(rf'\b{qty_value}\b', '', first_line_item)
-                    first_line_item = re.sub(r'Output\s+IGST\s*[-\d.% ]+', '', first_line_item, flags=re.IGNORECASE)
-                    first_line_item = re.sub(r'Output\s+CGST\s*[-\d.% ]+', '', first_line_item, flags=re.IGNORECASE)
-                    first_line_item = re.sub(r'Output\s+SGST\s*[-\d.% ]+', '', first_line_item, flags=re.IGNORECASE)
-                    first_line_item = re.sub(r'\s+', ' ', first_line_item).strip()
-
-
-                    items.append({
-                        'file_name': file_name,
-                        'invoice_number': invoice_number,
-                        'item_no': item_no,
-                        'item': first_line_item, # New field for first line
-                        'description': full_description, # Keep full description
-                        'qty_value': qty_value,
-                        'qty_unit': qty_unit,
-                        'rate': rate,
-                        'amount': amount,
-                        'hsn_sac': hsn
-                    })
-                    processed_item_numbers.add(item_no)
-
-                    # Move to the next potential item line
-                    idx = next_idx
+
+                    # Check if the next line starts with a number
+                    next_item_num_match = ITEM_NO_RE.match(next_line)
+
+                    is_likely_new_item = False
+                    if next_item_num_match:
+                        # Check if this line looks like a *new* item line
+                        next_line_hsn = HSN_RE.search(next_line) # HSN anywhere
+                        next_line_qty = QTY_NOS_RE.search(next_line) # Qty anywhere
+                        next_line_decimals = DECIMAL_RE.findall(next_line)
+
+                        # Conditions for being a new item line:
+                        # 1. Has HSN?
+                        # 2. Has Qty?
+                        # 3. Has at least two decimal numbers (likely rate/amount)?
+                        if next_line_hsn or next_line_qty or len(next_line_decimals) >= 2:
+                            is_likely_new_item = True
+                            # Optional: Add check for sequential item number?
+                            # try:
+                            #     if int(next_item_num_match.group(1)) > int(item_no):
+                            #         is_likely_new_item = True
+                            # except ValueError:
+                            #     pass # Ignore if conversion fails
+
+                    if is_likely_new_item:
+                        logging.debug("Detected likely new item line: %s. Stopping description.", next_line)
+                        break # Stop accumulating description, it's a new item
+                    else:
+                        # --- ADDED TAX AND TOTAL LINE CHECKS ---
+                        # Check 1: Does the line look like a tax line (CGST, SGST, IGST)?
+                        is_tax_line = TAX_LINE_RE.search(next_line)
+
+                        # Check 2: Does the line look like *only* a total amount?
+                        # Heuristic: Remove "Total" keyword (case-insensitive) and surrounding whitespace.
+                        # Check if the *entire remaining string* is just a decimal number.
+                        potential_total_text = TOTAL_WORD_RE.sub('', next_line).strip()
+                        # Allow for optional currency symbols or leading/trailing punctuation sometimes seen near totals
+                        potential_total_text = EDGE_NON_DIGITS_RE.sub('', potential_total_text).strip() 
+                        is_likely_total_line = AMOUNT_RE.fullmatch(potential_total_text)
+
+                        if is_tax_line:
+                            logging.debug("Detected tax line: %s. Stopping description.", next_line)
+                            break # Stop accumulating description before adding tax line
+                        elif is_likely_total_line:
+                             logging.debug("Detected likely total line: %s. Stopping description.", next_line)
+                             break # Stop accumulating description before adding total line
+                        # --- END TAX AND TOTAL LINE CHECKS ---
+
+                        # This is a continuation line (passes all checks)
+                        logging.debug("Adding description line: %s", next_line)
+                        description_lines.append(next_line)
+                        next_idx += 1
+
+                # --- After the inner while loop ---
+
+                # Join all description lines
+                full_description = ' '.join(description_lines)
+
+                # --- Perform cleaning on full_description ---
+                # Use the HSN/Qty/Decimals found on the *main line* for final assignment and cleaning
+
+                # Extract final values from main line analysis
+                hsn = main_line_hsn_match.group(1) if main_line_hsn_match else ""
+                qty_value = main_line_qty_match.group(1) if main_line_qty_match else ""
+                qty_unit = "NOS" if main_line_qty_match else ""
+
+                # Remove HSN code from description
+                if hsn:
+                    full_description = re.sub(rf'\b{hsn}\b', '', full_description)
+                # Also remove any other HSN-like numbers that might be in description text
+                full_description = HSN_RE.sub('', full_description)
+
+                # Remove Unit from description
+                if qty_unit:
+                    full_description = NOS_WORD_RE.sub('', full_description)
+
+                # Remove rate and amount values (using decimals found on main line) from description
+                for value in main_line_decimals:
+                    # Use regex to avoid replacing parts of other numbers
+                    full_description = re.sub(rf'(?<![\d.,]){re.escape(value)}(?![\d.,])', '', full_description)
+
+                # Remove quantity value from description
+                if qty_value:
+                    full_description = re.sub(rf'\b{qty_value}\b', '', full_description)
+
+                # --- START TAX INFO REMOVAL ---
+                for tax_info_re in TAX_INFO_RES:
+                    full_description = tax_info_re.sub('', full_description)
+                # --- END TAX INFO REMOVAL ---
+
+                # Clean up extra spaces
+                full_description = WHITESPACE_RE.sub(' ', full_description).strip()
+
+                # --- Assign final rate and amount based on main line analysis ---
+                rate = ""
+                amount = ""
+
+                if not qty_value: # Treat as service item if no qty on main line
+                    if len(main_line_decimals) >= 1:
+                        # Assume amount is the last decimal on the line for service items
+                        amount = main_line_decimals[-1]
+                        rate = ""
+                else: # Treat as regular item
+                    if len(main_line_decimals) >= 2:
+                        # Assuming Rate is first, Amount is second on the main line for product items
+                        # (Adjust if this assumption is wrong for your PDFs)
+                        rate = main_line_decimals[0]
+                        amount = main_line_decimals[1]
+                    elif len(main_line_decimals) == 1:
+                        # If only one number for product, assume it's amount
+                        amount = main_line_decimals[0]
+                        rate = ""
+                
+                # Get the first line for the 'Item' field
+                first_line_item = description_lines[0].strip() if description_lines else ''
+                # Clean the first line similar to how full_description is cleaned (remove HSN, Qty, Rate, Amount, Tax)
+                if hsn:
+                    first_line_item = re.sub(rf'\b{hsn}\b', '', first_line_item)
+                first_line_item = HSN_RE.sub('', first_line_item) # Remove other HSN-like
+                if qty_unit:
+                    first_line_item = NOS_WORD_RE.sub('', first_line_item)
+                for value in main_line_decimals:
+                     first_line_item = re.sub(rf'(?<![\d.,]){re.escape(value)}(?![\d.,])', '', first_line_item)
+                if qty_value:
+                    first_line_item = re.sub(rf'\b{qty_value}\b', '', first_line_item)
+                for tax_info_re in TAX_INFO_RES:
+                    first_line_item = tax_info_re.sub('', first_line_item)
+                first_line_item = WHITESPACE_RE.sub(' ', first_line_item).strip()
+
+
+                items.append({
+                    'file_name': file_name,
+                    'invoice_number': invoice_number,
+                    'item_no': item_no,
+                    'item': first_line_item, # New field for first line
+                    'description': full_description, # Keep full description
+                    'qty_value': qty_value,
+                    'qty_unit': qty_unit,
+                    'rate': rate,
+                    'amount': amount,
+                    'hsn_sac': hsn
+                })
+                processed_item_numbers.add(item_no)
+
+                # Move to the next potential item line
+                idx = next_idx
 
     # Sort items by item number (to ensure correct order)
     items.sort(key=lambda x: int(x['item_no']))
     
-    # Debug output
-    logging.debug("\n--- Extracted Item Details ---")
-    logging.debug(f"Found {len(items)} items")
-    for item in items:
-        logging.debug(f"Item {item['item_no']}: {item['description']} - {item['qty_value']} {item['qty_unit']} - Rate: {item['rate']} - Amount: {item['amount']}")
-    logging.debug("----------------------------\n")
+    # Debug output - built only when DEBUG is on, and logged as one record instead of one per item
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        dump = "".join(f"\nItem {item['item_no']}: {item['description']} - {item['qty_value']} {item['qty_unit']} - Rate: {item['rate']} - Amount: {item['amount']}"
+                       for item in items)
+        logging.debug("\n--- Extracted Item Details ---\nFound %s items%s\n----------------------------\n", len(items), dump)
     
     return items
 
 def process_pdf(file_path):
     try:
+        # Open and read the PDF once; header and items are both parsed from this text
+        page_texts = extract_page_texts(file_path)
+
         # Extract header data
-        header_data = extract_header_from_pdf(file_path)
+        header_data = extract_header_from_pdf(file_path, page_texts)
         
         # Get the input file name without extension
         input_file_name = os.path.splitext(os.path.basename(file_path))[0]
@@ -768,7 +778,7 @@ def process_pdf(file_path):
             ])
         
         # Extract item details
-        items = extract_items_from_pdf(file_path)
+        items = extract_items_from_pdf(file_path, page_texts)
         
         # For items file - always write headers since we're creating new files for each PDF
         with open(items_csv, 'w', newline='', encoding='utf-8') as f:
@@ -810,13 +820,12 @@ def process_pdf(file_path):
 # === FILE MOVING (ERROR) WITH TIMESTAMP ===
 # Renamed from move_file to be specific for error handling
 def move_to_error(file_path, target_dir):
-    """Moves a file to the specified target directory, adding a timestamp."""
+    """Moves a file to the specified target directory, adding a timestamp and a unique counter."""
     try:
         os.makedirs(target_dir, exist_ok=True)
         base_name = os.path.basename(file_path)
         name, ext = os.path.splitext(base_name)
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        new_name = f"{name}_{timestamp}{ext}"
+        new_name = f"{name}_{int(time.time())}_{next(_move_counter)}{ext}"
         target_path = os.path.join(target_dir, new_name)
         shutil.move(file_path, target_path)
         logging.info(f"Moved '{base_name}' to '{target_path}'")
@@ -971,6 +980,19 @@ def handle_file(file_path):
 
 
 # === PROCESS EXISTING FILES ===
+def init_extract_worker(log_queue):
+    """Pool initializer: route the worker's log records to the parent's handlers"""
+    root = logging.getLogger()
+    for handler in root.handlers[:]: # Inherited from the parent when workers are forked
+        root.removeHandler(handler)
+        handler.close()
+    root.addHandler(QueueHandler(log_queue))
+    root.setLevel(log_level)
+
+def handle_existing_file(file_path):
+    logging.info(f"📄 Processing existing file: {os.path.basename(file_path)}")
+    handle_file(file_path)
+
 def process_existing_files():
     logging.info("🔍 Checking for existing files...")
     if not os.path.exists(INPUT_DIR):
@@ -978,13 +1000,43 @@ def process_existing_files():
         os.makedirs(INPUT_DIR)
         return
         
-    file_count = 0
-    for filename in os.listdir(INPUT_DIR):
-        if filename.lower().endswith('.pdf'):
-            file_path = os.path.join(INPUT_DIR, filename)
-            logging.info(f"📄 Processing existing file: {filename}")
-            handle_file(file_path)
-            file_count += 1
+    file_paths = [os.path.join(INPUT_DIR, filename) for filename in os.listdir(INPUT_DIR)
+                  if filename.lower().endswith('.pdf')]
+    file_count = len(file_paths)
+    workers = min(EXTRACT_WORKERS, file_count)
+
+    if workers > 1:
+        # Each PDF is independent (own output CSVs and archive zip), so a backlog is spread
+        # over worker processes; threads would be serialized by the GIL during extraction.
+        # Workers log through a queue so only this process writes (and rotates) the log file.
+        logging.info(f"⚙️ Processing {file_count} existing files with {workers} worker processes")
+        log_queue = multiprocessing.Queue()
+        listener = QueueListener(log_queue, *logging.getLogger().handlers, respect_handler_level=True)
+        listener.start()
+        pool_failed = False
+        try:
+            with ProcessPoolExecutor(max_workers=workers, initializer=init_extract_worker, initargs=(log_queue,)) as executor:
+                # handle_file deals with its own errors; this only waits for every file to finish
+                for _ in executor.map(handle_existing_file, file_paths, chunksize=max(1, file_count // (workers * 4))):
+                    pass
+        except Exception as e:
+            # e.g. a worker process died (BrokenProcessPool)
+            logging.error(f"❌ Error processing existing files in worker processes: {e}")
+            logging.exception("Traceback:")
+            pool_failed = True
+        finally:
+            listener.stop()
+        if pool_failed:
+            # Files the workers did not finish are still in the input folder, and the watcher only
+            # reacts to new files, so pick them up here, one at a time in this process
+            remaining = [os.path.join(INPUT_DIR, filename) for filename in os.listdir(INPUT_DIR)
+                         if filename.lower().endswith('.pdf')]
+            logging.warning(f"⚠️ Processing {len(remaining)} remaining existing files without worker processes")
+            for file_path in remaining:
+                handle_existing_file(file_path)
+    else:
+        for file_path in file_paths:
+            handle_existing_file(file_path)
     
     if file_count > 0:
         logging.info(f"✅ Processed {file_count} existing PDF files")
@@ -1048,6 +1100,8 @@ def signal_handler(sig, frame):
 
 # === MAIN ===
 if __name__ == "__main__":
+    setup_logging()
+
     # Ensure directories exist
     for directory in [INPUT_DIR, ARCHIVE_DIR, ERROR_DIR, OUTPUT_DIR]:
         os.makedirs(directory, exist_ok=True)
@@ -1,20 +1,140 @@
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import csv
+import collections
+import errno
+import gzip
+import hashlib
+import itertools
 import json
 import os
 import traceback
 import shutil
 import logging
+import math
+import sqlite3
+import struct
+import logging.handlers
+import queue
+import atexit
 import time # Added for potential retries or delays
+import threading
+import functools
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
 from datetime import datetime
 from dotenv import load_dotenv
 
+try:
+    import pandas as pd # Optional: C parser used for very large CSVs
+except ImportError:
+    pd = None
+
+try:
+    import orjson # Optional: faster JSON for upload payloads and API responses
+except ImportError:
+    orjson = None
+
+try:
+    import ijson # Optional: streams large table downloads instead of loading them whole
+except ImportError:
+    ijson = None
+
+def dumps_json(obj):
+    """Serializes obj to compact JSON bytes, with orjson when it is installed."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+def loads_json(response):
+    """Parses a JSON response body, with orjson when it is installed."""
+    if orjson is not None:
+        return orjson.loads(response.content)
+    return response.json()
+
 # Load environment variables from .env file
 load_dotenv()
 
-# --- GristUploader Class (unchanged) ---
+# --- Rate Limiting ---
+class RateLimiter:
+    """
+    Paces Grist requests across all worker threads. A 429 response pushes back the
+    next allowed request by its Retry-After (or an exponential backoff) and is retried.
+    Once X-RateLimit-Remaining drops below pace_below, the remaining requests are spread
+    evenly until X-RateLimit-Reset; above that, requests are not slowed at all.
+    """
+    def __init__(self, max_retries=5, initial_backoff=1.0, pace_below=10):
+        self.max_retries = max_retries
+        self.initial_backoff = initial_backoff
+        self.pace_below = pace_below
+        self._lock = threading.Lock()
+        self._next_allowed_ts = 0.0
+
+    def defer(self, delay):
+        """Holds back every request for at least `delay` seconds from now."""
+        with self._lock:
+            self._next_allowed_ts = max(self._next_allowed_ts, time.monotonic() + delay)
+
+    def send(self, send_request):
+        """Calls send_request() once the limiter allows it, retrying on 429. Returns the final response."""
+        backoff = self.initial_backoff
+        for attempt in range(self.max_retries + 1):
+            with self._lock:
+                delay = self._next_allowed_ts - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            response = send_request()
+            if response.status_code != 429 or attempt == self.max_retries:
+                self._pace_from_headers(response)
+                return response
+            retry_after = _header_seconds(response, 'Retry-After')
+            delay = retry_after if retry_after is not None else backoff
+            response.close() # Not handed back, so release its pooled connection (it may be streamed)
+            logging.warning(f"Grist rate limit hit (429). Retrying in {delay:.1f}s (attempt {attempt + 1}/{self.max_retries}).")
+            self.defer(delay)
+            backoff *= 2
+
+    def _pace_from_headers(self, response):
+        remaining = _header_seconds(response, 'X-RateLimit-Remaining')
+        reset = _header_seconds(response, 'X-RateLimit-Reset')
+        if remaining is None or reset is None or remaining >= self.pace_below:
+            return
+        if reset > 1e9: # Epoch timestamp rather than seconds until reset
+            reset -= time.time()
+        if reset > 0:
+            self.defer(reset / max(remaining, 1))
+
+def _header_seconds(response, name):
+    """Returns a numeric response header as a float, or None if missing or not a number."""
+    try:
+        return float(response.headers[name])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+class PostRetry(Retry):
+    """
+    Retry that also re-sends a POST answered with 503 (Service Unavailable): Grist did not
+    process it, so sending it again cannot duplicate rows. Other 5xx responses are only
+    retried for the methods in allowed_methods.
+    """
+    def is_retry(self, method, status_code, has_retry_after=False):
+        if method.upper() == "POST" and status_code == 503:
+            return True
+        return super().is_retry(method, status_code, has_retry_after)
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter that applies a default (connect, read) timeout to requests sent without one."""
+    def __init__(self, *args, timeout=None, **kwargs):
+        self.timeout = timeout
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, timeout=None, **kwargs):
+        return super().send(request, timeout=self.timeout if timeout is None else timeout, **kwargs)
+
+
+# --- GristUploader Class ---
 class GristUploader:
-    def __init__(self, doc_id, api_key=None, server_url=None):
+    def __init__(self, doc_id, api_key=None, server_url=None, pool_maxsize=16):
         """Initialize the GristUploader with necessary parameters."""
         self.doc_id = doc_id
         self.api_key = api_key or os.getenv('GRIST_API_KEY')
@@ -31,27 +151,103 @@ class GristUploader:
             'Content-Type': 'application/json',
         }
 
+        # One pooled session for all API calls so keep-alive connections are reused
+        # instead of paying a new TCP/TLS handshake per request
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+        # Transient failures are retried per request this many times, so one flaky batch does not
+        # fail the whole file. GETs are retried after any listed 5xx or a read timeout. A POST (/records,
+        # /apply) is only retried on 503 and on connection errors (request never sent or not processed):
+        # after another 5xx or a read timeout it may already be committed, and re-sending it would
+        # duplicate rows. 429s are retried by the RateLimiter.
+        max_retries = int(os.getenv('GRIST_MAX_RETRIES', '5'))
+        # No request may hang forever on a stalled connection (the read timeout is per socket read,
+        # so a large streamed download is not cut off)
+        timeout = (float(os.getenv('GRIST_CONNECT_TIMEOUT', '10')), float(os.getenv('GRIST_READ_TIMEOUT', '120')))
+        adapter = TimeoutHTTPAdapter(
+            timeout=timeout,
+            pool_connections=4,
+            pool_maxsize=pool_maxsize,
+            max_retries=PostRetry(
+                total=max_retries,
+                backoff_factor=0.5, # 0.5s, 1s, 2s, ... capped at backoff_max
+                backoff_max=30,
+                backoff_jitter=0.5, # Up to 0.5s extra, so worker threads don't retry in lockstep
+                status_forcelist=[500, 502, 503, 504],
+                respect_retry_after_header=False, # 429/Retry-After is handled by the RateLimiter
+                allowed_methods=frozenset({"GET"}),
+                raise_on_status=False # Hand the final response back so raise_for_status() reports it
+            )
+        )
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        # Shared by all threads using this uploader
+        self.rate_limiter = RateLimiter(max_retries=max_retries)
+
+        # Request bodies above this size are gzip-compressed (turned off if the server answers 415)
+        self.gzip_requests = os.getenv('GRIST_GZIP_REQUESTS', '1') == '1'
+        self.gzip_min_bytes = int(os.getenv('GRIST_GZIP_MIN_BYTES', '4096'))
+        # 1-9; 3 is still cheap next to a network round trip and shrinks record JSON noticeably more than 1
+        self.gzip_level = int(os.getenv('GRIST_GZIP_LEVEL', '3'))
+
+    def close(self):
+        """Close the underlying HTTP session and its pooled connections."""
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
     def get_tables(self):
         """Get list of tables in the document."""
         url = f"{self.server_url}/api/docs/{self.doc_id}/tables"
-        response = requests.get(url, headers=self.headers)
+        response = self.rate_limiter.send(lambda: self.session.get(url))
         response.raise_for_status() # Raises HTTPError for bad responses (4xx or 5xx)
-        return response.json()
+        return loads_json(response)
 
     def get_table_data(self, table_id):
         """Get data from a specific table."""
         url = f"{self.server_url}/api/docs/{self.doc_id}/tables/{table_id}/records"
-        response = requests.get(url, headers=self.headers)
+        response = self.rate_limiter.send(lambda: self.session.get(url))
         response.raise_for_status()
-        return response.json()
-
-    def get_table_columns(self, table_id):
-        """Get column information for a specific table."""
+        return loads_json(response)
+
+    def iter_table_records(self, table_id):
+        """
+        Yields the records of a table one at a time. With ijson installed the response is
+        parsed as it arrives, so a very large table is never held in memory all at once.
+        """
+        if ijson is None:
+            yield from self.get_table_data(table_id).get("records", [])
+            return
+        url = f"{self.server_url}/api/docs/{self.doc_id}/tables/{table_id}/records"
+        response = self.rate_limiter.send(lambda: self.session.get(url, stream=True))
+        with response:
+            response.raise_for_status()
+            response.raw.decode_content = True # Let urllib3 undo any gzip Content-Encoding
+            yield from ijson.items(response.raw, "records.item", use_float=True)
+
+    def get_table_columns(self, table_id, cache=None):
+        """
+        Get column information for a specific table.
+        If a cache dict is given, a cached entry for this table is revalidated with
+        If-None-Match and reused on 304; a new ETag from Grist updates the entry in place.
+        """
         url = f"{self.server_url}/api/docs/{self.doc_id}/tables/{table_id}/columns"
-        response = requests.get(url, headers=self.headers)
+        cache_key = f"{self.server_url}|{self.doc_id}|{table_id}"
+        cached = cache.get(cache_key) if cache is not None else None
+        headers = {'If-None-Match': cached['etag']} if cached else None
+        response = self.rate_limiter.send(lambda: self.session.get(url, headers=headers))
+        if cached and response.status_code == 304:
+            return cached['data'] # Schema unchanged since the last run
         response.raise_for_status()
-        data = response.json()
+        data = loads_json(response)
         # print(f"Raw column data for {table_id}: {json.dumps(data, indent=2)}") # Debug print
+        etag = response.headers.get('ETag')
+        if cache is not None and etag:
+            cache[cache_key] = {"etag": etag, "data": data}
         return data
 
     def add_records(self, table_id, records):
@@ -66,216 +262,493 @@ class GristUploader:
         # print(f"Sending request to: {url}") # Debug print
         # print(f"First record sample: {json.dumps(records[0], indent=2)}") # Debug print
 
-        response = requests.post(url, headers=self.headers, json=data)
+        response = self._post_json(url, data)
+        response.raise_for_status() # Let exceptions propagate
+        return loads_json(response)
+
+    def apply_actions(self, actions):
+        """Applies a list of Grist user actions (e.g. BulkAddRecord) in one request and one document transaction."""
+        url = f"{self.server_url}/api/docs/{self.doc_id}/apply"
+        response = self._post_json(url, actions)
         response.raise_for_status() # Let exceptions propagate
-        return response.json()
+        return loads_json(response)
+
+    def _post_json(self, url, payload):
+        """POSTs a JSON payload, gzip-compressing large bodies unless the server has refused them."""
+        # Serialized once up front (session headers already set Content-Type: application/json)
+        body = dumps_json(payload)
+        if self.gzip_requests and len(body) > self.gzip_min_bytes:
+            compressed = gzip.compress(body, compresslevel=self.gzip_level)
+            response = self.rate_limiter.send(lambda: self.session.post(url, data=compressed, headers={'Content-Encoding': 'gzip'}))
+            if response.status_code != 415:
+                return response
+            logging.warning("Grist rejected a gzip-compressed request body (415). Sending uncompressed bodies from now on.")
+            self.gzip_requests = False
+        return self.rate_limiter.send(lambda: self.session.post(url, data=body))
 
 # --- Helper Functions (mostly unchanged) ---
-def create_column_mapping_from_grist(columns_data, csv_headers):
-    """Create a mapping from CSV headers to Grist column IDs"""
-    mapping = {}
-    grist_columns = []
-    if "columns" in columns_data and isinstance(columns_data["columns"], list):
-        grist_columns = {col["fields"]["label"]: col["id"] for col in columns_data["columns"] if "id" in col and "fields" in col and "label" in col["fields"]}
-        grist_col_ids = {col["id"] for col in columns_data["columns"] if "id" in col} # Keep track of raw IDs too
 
-    # print(f"Grist Labels->IDs: {grist_columns}") # Debug
-    # print(f"Grist IDs: {grist_col_ids}") # Debug
+COLUMNS_CACHE_FILENAME = ".grist_columns_cache.json"
+
+def load_columns_cache(cache_path):
+    """Loads the on-disk Grist column cache, or returns an empty one if missing or unreadable."""
+    try:
+        with open(cache_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        logging.warning(f"Ignoring unreadable Grist column cache '{cache_path}': {e}")
+        return {}
+
+def save_columns_cache(cache_path, cache):
+    """Writes the Grist column cache; failures only cost a full fetch next run."""
+    try:
+        with open(cache_path, 'w', encoding='utf-8') as f:
+            json.dump(cache, f)
+    except Exception as e:
+        logging.warning(f"Could not write Grist column cache '{cache_path}': {e}")
+
+# Grist column lookups, built once per table: exact label/ID and normalized (lowercase, space->underscore) label/ID -> column ID,
+# plus the mappings already generated for each distinct CSV header row (invoices of one kind share the same headers)
+ColumnLookup = collections.namedtuple('ColumnLookup', ['labels', 'ids', 'norm_labels', 'norm_ids', 'mappings'])
+
+# Lowercases ASCII letters and maps space to underscore in a single str.translate pass
+_NORM = str.maketrans({" ": "_", **{chr(c): chr(c + 32) for c in range(ord('A'), ord('Z') + 1)}})
+
+def build_lookup(columns_data):
+    """Builds a ColumnLookup from a Grist columns response so header matching is plain dict lookups."""
+    labels = {}
+    ids = {}
+    if "columns" in columns_data and isinstance(columns_data["columns"], list):
+        labels = {col["fields"]["label"]: col["id"] for col in columns_data["columns"] if "id" in col and "fields" in col and "label" in col["fields"]}
+        ids = {col["id"]: col["id"] for col in columns_data["columns"] if "id" in col} # Keep track of raw IDs too
+
+    norm_labels = {}
+    for label, col_id in labels.items():
+        norm_labels.setdefault(label.translate(_NORM), col_id) # First match wins, as in the old linear scan
+    norm_ids = {}
+    for col_id in ids:
+        norm_ids.setdefault(col_id.translate(_NORM), col_id)
+    return ColumnLookup(labels, ids, norm_labels, norm_ids, {})
+
+def create_column_mapping_from_grist(lookup, csv_headers):
+    """Create a mapping from CSV headers to Grist column IDs using a prebuilt ColumnLookup"""
+    headers_key = tuple(csv_headers)
+    mapping = lookup.mappings.get(headers_key)
+    if mapping is not None:
+        return mapping # Same header row as an earlier CSV; the mapping is never modified by callers
 
+    mapping = {}
     for csv_header in csv_headers:
         clean_csv_header = csv_header.strip()
-        # 1. Try exact label match
-        if clean_csv_header in grist_columns:
-            mapping[csv_header] = grist_columns[clean_csv_header]
-            continue
-        # 2. Try exact ID match (if CSV header happens to be the ID)
-        if clean_csv_header in grist_col_ids:
-             mapping[csv_header] = clean_csv_header
-             continue
-        # 3. Try label match ignoring case and replacing space with underscore
-        normalized_csv_header = clean_csv_header.lower().replace(" ", "_")
-        found_match = False
-        for label, col_id in grist_columns.items():
-             if label.lower().replace(" ", "_") == normalized_csv_header:
-                 mapping[csv_header] = col_id
-                 found_match = True
-                 break
-        if found_match:
-            continue
-        # 4. Try ID match ignoring case and replacing space with underscore
-        for col_id in grist_col_ids:
-             if col_id.lower().replace(" ", "_") == normalized_csv_header:
-                 mapping[csv_header] = col_id
-                 found_match = True
-                 break
-        # if found_match: # Already handled by continue
-        #     continue
-
-        # If no match found, maybe log a warning or skip
-        # print(f"Warning: No Grist column found for CSV header '{csv_header}'")
+        normalized_csv_header = clean_csv_header.translate(_NORM)
+        # 1. exact label, 2. exact ID, 3. normalized label, 4. normalized ID
+        col_id = (lookup.labels.get(clean_csv_header)
+                  or lookup.ids.get(clean_csv_header)
+                  or lookup.norm_labels.get(normalized_csv_header)
+                  or lookup.norm_ids.get(normalized_csv_header))
+        if col_id:
+            mapping[csv_header] = col_id
+        # else: no Grist column for this CSV header, it is skipped
 
     # print(f"Generated column mapping: {json.dumps(mapping, indent=2)}") # Debug
+    lookup.mappings[headers_key] = mapping # Worker threads may race here, but they store equal mappings
     return mapping
 
-def read_csv_to_records(csv_file_path, column_mapping):
-    """Read a CSV file and convert it to records for Grist using the mapping."""
-    records = []
+def iter_csv_records(csv_file_path):
+    """
+    Opens a CSV file once and returns (headers, rows): the header row (None for an
+    empty file) and a generator over the remaining rows. The file is closed when the
+    generator is exhausted or closed.
+    """
+    csvfile = open(csv_file_path, 'r', newline='', encoding='utf-8')
     try:
-        with open(csv_file_path, 'r', newline='', encoding='utf-8') as csvfile:
-            reader = csv.DictReader(csvfile)
-            if not reader.fieldnames: # Check if headers exist
-                 print(f"Warning: CSV file seems empty or has no headers: {csv_file_path}")
-                 return []
-            for row in reader:
-                record = {"fields": {}}
-                valid_row = False
-                for csv_col, grist_field in column_mapping.items():
-                    if csv_col in row and row[csv_col] is not None: # Check if column exists in row and has value
-                        record["fields"][grist_field] = row[csv_col]
-                        valid_row = True # Mark row as having at least one mapped value
-                if valid_row: # Only add records that have at least one mapped field
-                    records.append(record)
-    except FileNotFoundError:
-        print(f"Error: File not found while reading: {csv_file_path}")
-        raise # Re-raise to be caught by the processing logic
+        reader = csv.reader(csvfile)
+        headers = next(reader, None)
+    except Exception:
+        csvfile.close()
+        raise
+    if headers is None:
+        csvfile.close()
+        return None, iter(())
+
+    def rows():
+        try:
+            yield from reader
+        finally:
+            csvfile.close()
+    return headers, rows()
+
+def read_small_csv(csv_file_path):
+    """
+    Reads a whole small CSV (a Header file is usually one row) in a single open and returns
+    (headers, data_rows), with headers None for an empty file. For a Header file the result
+    is used both for the invoice number check and for the upload, so it is parsed once.
+    """
+    with open(csv_file_path, 'r', newline='', encoding='utf-8') as csvfile:
+        reader = csv.reader(csvfile)
+        headers = next(reader, None)
+        return headers, list(reader)
+
+def rows_to_records(csv_headers, rows, column_mapping):
+    """
+    Yield records for Grist from CSV rows using the mapping.
+    Records are produced lazily so memory use does not grow with the file size.
+    """
+    # Resolve each mapped column to its position once, so rows are read by index with no per-row dict
+    header_index = {csv_col: i for i, csv_col in enumerate(csv_headers)}
+    col_index_to_grist = [(header_index[csv_col], grist_field) for csv_col, grist_field in column_mapping.items() if csv_col in header_index]
+    # Rows at least this wide hold every mapped column, so the comprehension needs no bounds check
+    full_width = max((i for i, _ in col_index_to_grist), default=-1) + 1
+    try:
+        for row in rows:
+            if len(row) >= full_width:
+                fields = {grist_field: row[i] for i, grist_field in col_index_to_grist}
+            else:
+                # Short rows just leave the missing columns out
+                row_len = len(row)
+                fields = {grist_field: row[i] for i, grist_field in col_index_to_grist if i < row_len}
+            if fields: # Only add records that have at least one mapped field
+                yield {"fields": fields}
     except Exception as e:
-        print(f"Error reading CSV file {csv_file_path}: {e}")
-        raise # Re-raise
-    return records
+        print(f"Error reading CSV rows: {e}")
+        raise # Re-raise to be caught by the processing logic
+
+def read_csv_chunks_pandas(csv_file_path, column_mapping, chunk_size):
+    """
+    Yields batches of Grist records parsed with pandas' C reader, chunk_size rows at a time.
+    Used instead of the csv module for very large files; needs pandas installed.
+    """
+    # Unmapped columns are dropped by the parser itself rather than after building the frame
+    for df in pd.read_csv(csv_file_path, chunksize=chunk_size, dtype=str, na_filter=False, keep_default_na=False,
+                          encoding='utf-8', engine='c', usecols=lambda c: c in column_mapping):
+        df = df.rename(columns=column_mapping)
+        # Cells missing from short rows come back as NaN (not str) and are left out, as in rows_to_records
+        batch = [{"fields": fields} for fields in (
+            {k: v for k, v in r.items() if isinstance(v, str)} for r in df.to_dict(orient='records')
+        ) if fields]
+        if batch:
+            yield batch
+
+def dedupe_records(records):
+    """
+    Yields records, skipping any whose fields exactly repeat an earlier record in the same file.
+    Keeps one key per distinct record (a few hundred bytes each), so memory grows with the
+    number of distinct rows; enabled with GRIST_DEDUPE=1.
+    """
+    seen = set()
+    for record in records:
+        key = tuple(sorted(record["fields"].items()))
+        if key in seen:
+            continue
+        seen.add(key)
+        yield record
+
+def chunked(iterable, size):
+    """Yields successive lists of up to `size` items from any iterable."""
+    iterator = iter(iterable)
+    while batch := list(itertools.islice(iterator, size)):
+        yield batch
 
 
 # --- Invoice Log Functions ---
 
-PROCESSED_INVOICES_LOG_FILENAME = "processed_invoices.log"
+PROCESSED_INVOICES_DB_FILENAME = "processed_invoices.sqlite"
+INVOICE_BLOOM_FILENAME = "processed_invoices.bloom" # Saved bloom prefilter, reused while the store is unchanged
+PROCESSED_INVOICES_LOG_FILENAME = "processed_invoices.log" # Plain-text log used before the SQLite store; imported once, then renamed
+PROCESSED_INVOICES_AUDIT_FILENAME = "processed_invoices_audit.log" # Human-readable record of invoices uploaded, appended once per run; never read back
 INVOICE_NUMBER_COLUMN_LABEL = "Invoice Number" # Assumed label in Grist and CSV Header
 
-def get_grist_column_id_by_label(columns_data, label):
-    """Finds the Grist column ID for a given label."""
-    if "columns" in columns_data and isinstance(columns_data["columns"], list):
-        for col in columns_data["columns"]:
-            if "fields" in col and col["fields"].get("label") == label and "id" in col:
-                return col["id"]
-    return None
+def get_grist_column_id_by_label(lookup, label):
+    """Finds the Grist column ID for a given label in a table's ColumnLookup."""
+    return lookup.labels.get(label)
 
-def fetch_and_populate_log(log_path, uploader: GristUploader, header_table_id, invoice_col_label):
-    """Fetches existing invoice numbers from Grist and populates the log file."""
-    print(f"Log file '{log_path}' not found. Fetching existing invoice numbers from Grist table '{header_table_id}'...")
-    processed_invoices = set()
+def open_invoice_db(db_path):
+    """
+    Opens (creating it if needed) the SQLite store of processed invoice numbers.
+    The connection is shared by the worker threads, which only use it while holding invoice_lock.
+    """
+    conn = sqlite3.connect(db_path, check_same_thread=False)
+    conn.execute("CREATE TABLE IF NOT EXISTS inv(n TEXT PRIMARY KEY)")
+    conn.execute("CREATE TABLE IF NOT EXISTS meta(k TEXT PRIMARY KEY, v TEXT)") # 'populated' once filled from Grist or the old log
+    conn.commit()
+    return conn
+
+def _mark_invoice_db_populated(conn):
+    conn.execute("INSERT OR REPLACE INTO meta VALUES('populated', ?)", (datetime.now().isoformat(timespec='seconds'),))
+    conn.commit()
+
+def fetch_and_populate_log(conn, uploader: GristUploader, header_table_id, header_lookup, invoice_col_label):
+    """Fetches existing invoice numbers from Grist and stores them in the processed invoice store."""
+    print(f"Processed invoice store is empty. Fetching existing invoice numbers from Grist table '{header_table_id}'...")
     try:
-        # 1. Get column ID for Invoice Number
-        header_columns = uploader.get_table_columns(header_table_id)
-        invoice_col_id = get_grist_column_id_by_label(header_columns, invoice_col_label)
+        # 1. Get column ID for Invoice Number (columns were already fetched at startup)
+        invoice_col_id = get_grist_column_id_by_label(header_lookup, invoice_col_label)
         if not invoice_col_id:
             logging.error(f"Could not find column with label '{invoice_col_label}' in Grist table '{header_table_id}'. Cannot create initial log.")
             # Decide behaviour: raise error or return empty set? Let's return empty for now.
-            print(f"Error: Column '{invoice_col_label}' not found in Grist. Initial log file will be empty.")
-            # Create an empty file to prevent re-fetching attempts
-            with open(log_path, 'w', encoding='utf-8') as f:
-                pass # Create empty file
-            return processed_invoices # Return empty set
+            print(f"Error: Column '{invoice_col_label}' not found in Grist. Initial invoice store will be empty.")
+            # Mark the store as populated to prevent re-fetching attempts
+            _mark_invoice_db_populated(conn)
+            return 0
 
-        # 2. Get all records from the header table
+        # 2. Stream all records from the header table into the store, in one transaction
         print(f"Fetching all records from Grist table '{header_table_id}' to get invoice numbers...")
-        # Note: This might be slow for very large tables. Grist API might have pagination.
-        # For simplicity, assuming get_table_data fetches all for now.
-        # TODO: Implement pagination if needed for very large tables.
-        all_records_data = uploader.get_table_data(header_table_id)
-        records = all_records_data.get("records", [])
-        print(f"Found {len(records)} records in Grist table '{header_table_id}'.")
-
-        # 3. Extract invoice numbers
-        for record in records:
-            fields = record.get("fields", {})
-            invoice_num = fields.get(invoice_col_id)
-            if invoice_num: # Check if not None or empty string
-                processed_invoices.add(str(invoice_num).strip()) # Ensure string and strip whitespace
-
-        # 4. Write to log file
-        print(f"Writing {len(processed_invoices)} unique invoice numbers to '{log_path}'...")
-        with open(log_path, 'w', encoding='utf-8') as f:
-            for inv_num in sorted(list(processed_invoices)): # Sort for readability
-                f.write(inv_num + '\n')
-        print("Log file created successfully.")
+        # Note: Grist returns the whole table in one response; it is parsed incrementally
+        # (with ijson installed) and written in chunks, so memory does not grow with the table.
+        record_count = 0
+        for records in chunked(uploader.iter_table_records(header_table_id), 10000):
+            record_count += len(records)
+            # 3. Extract invoice numbers (skipping None or empty), as stripped strings
+            invoice_nums = (record.get("fields", {}).get(invoice_col_id) for record in records)
+            conn.executemany("INSERT OR IGNORE INTO inv VALUES(?)", ((str(n).strip(),) for n in invoice_nums if n))
+        print(f"Found {record_count} records in Grist table '{header_table_id}'.")
+
+        # 4. Mark the store as filled
+        unique_count = conn.execute("SELECT COUNT(*) FROM inv").fetchone()[0]
+        print(f"Wrote {unique_count} unique invoice numbers to the processed invoice store.")
+        _mark_invoice_db_populated(conn)
+        print("Processed invoice store created successfully.")
 
     except requests.exceptions.RequestException as e:
+        conn.rollback()
         logging.error(f"Network error fetching data from Grist for initial log: {e}")
-        print(f"Error: Network error connecting to Grist. Could not create initial log file '{log_path}'.")
-        # Don't create the file, so it tries again next time.
-        # Return empty set, processing will likely fail later anyway.
-        return set()
+        print("Error: Network error connecting to Grist. Could not populate the processed invoice store.")
+        # Not marked as populated, so it tries again next time.
+        # Processing will likely fail later anyway.
+        return 0
     except Exception as e:
-        logging.error(f"Error fetching or writing initial invoice log '{log_path}': {e}\n{traceback.format_exc()}")
-        print(f"Error: Failed to create initial log file '{log_path}'. See error log.")
-        # Don't create the file. Return empty set.
-        return set()
-
-    return processed_invoices
-
-def load_or_create_invoice_log(log_path, uploader, header_table_id, invoice_col_label):
-    """Loads processed invoices from the log file, or creates it by fetching from Grist if it doesn't exist."""
-    processed_invoices = set()
-    if os.path.exists(log_path):
-        print(f"Loading processed invoices from '{log_path}'...")
+        conn.rollback()
+        logging.error(f"Error fetching or writing initial invoice numbers: {e}\n{traceback.format_exc()}")
+        print("Error: Failed to populate the processed invoice store. See error log.")
+        # Not marked as populated.
+        return 0
+
+    return unique_count
+
+def load_or_create_invoice_log(db_path, legacy_log_path, uploader, header_table_id, header_lookup, invoice_col_label):
+    """
+    Opens the processed invoice store, filling it on first use from the old plain-text
+    log (if there is one) or else from the invoice numbers already in Grist.
+    Returns the open sqlite3 connection; lookups are then single indexed queries.
+    """
+    conn = open_invoice_db(db_path)
+    if conn.execute("SELECT 1 FROM meta WHERE k = 'populated'").fetchone():
+        print(f"Using processed invoice store '{db_path}'.")
+    elif os.path.exists(legacy_log_path):
+        print(f"Importing processed invoices from '{legacy_log_path}' into '{db_path}'...")
         try:
-            with open(log_path, 'r', encoding='utf-8') as f:
-                for line in f:
-                    invoice_num = line.strip()
-                    if invoice_num: # Avoid adding empty lines
-                        processed_invoices.add(invoice_num)
-            print(f"Loaded {len(processed_invoices)} processed invoice numbers.")
+            with open(legacy_log_path, 'r', encoding='utf-8') as f:
+                cur = conn.executemany("INSERT OR IGNORE INTO inv VALUES(?)",
+                                       ((line.strip(),) for line in f if line.strip())) # Avoid adding empty lines
+            _mark_invoice_db_populated(conn)
+            print(f"Imported {cur.rowcount} processed invoice numbers.")
+            # The old log stops growing after the import, so it must never seed a store again:
+            # a lost store is instead rebuilt from Grist, which has the complete history
+            try:
+                os.replace(legacy_log_path, legacy_log_path + '.imported')
+            except OSError as e:
+                logging.warning(f"Could not rename imported invoice log '{legacy_log_path}': {e}. Please rename or remove it manually.")
         except Exception as e:
-            logging.error(f"Error reading invoice log file '{log_path}': {e}. Treating as empty.")
-            print(f"Warning: Could not read existing log file '{log_path}'. Assuming no invoices processed yet.")
-            # Proceed as if the file didn't exist, but log the error.
-            # Optionally, could try to fetch from Grist again here, but might overwrite a corrupted log.
-            # Let's return empty for safety.
-            return set()
+            conn.rollback()
+            logging.error(f"Error reading invoice log file '{legacy_log_path}': {e}. Treating as empty.")
+            print(f"Warning: Could not read existing log file '{legacy_log_path}'. Assuming no invoices processed yet.")
+            # Proceed with an empty store, but log the error. It is not marked as populated,
+            # so the import is tried again next run.
     else:
-        # File doesn't exist, fetch from Grist and create it
-        processed_invoices = fetch_and_populate_log(log_path, uploader, header_table_id, invoice_col_label)
+        # Nothing to import, fetch from Grist
+        fetch_and_populate_log(conn, uploader, header_table_id, header_lookup, invoice_col_label)
 
-    return processed_invoices
+    return conn
 
-def append_invoice_to_log(log_path, invoice_number):
-    """Appends a successfully processed invoice number to the log file."""
+class BloomFilter:
+    """
+    Fixed-size Bloom filter over strings. A miss means the string was never added; a hit
+    may be a false positive (about error_rate once capacity strings are added), so hits are
+    confirmed against the invoice store. Uses capacity * ~29 bits at the default error rate.
+    """
+    FILE_MAGIC = b'INVBLOOM1'
+    FILE_HEADER = struct.Struct('<5Q') # capacity, num_bits, num_hashes, then the two-part store version
+
+    def __init__(self, capacity, error_rate=1e-6):
+        capacity = max(capacity, 1)
+        self.capacity = capacity
+        self.num_bits = max(8, math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.num_hashes = max(1, round(self.num_bits / capacity * math.log(2)))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+
+    def save(self, path, version):
+        """Writes the filter to path (replacing it atomically), tagged with the store version it reflects."""
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(self.FILE_MAGIC)
+            f.write(self.FILE_HEADER.pack(self.capacity, self.num_bits, self.num_hashes, *version))
+            f.write(self.bits)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """Reads a filter written by save(). Returns (filter, version); raises ValueError if the file is damaged."""
+        with open(path, 'rb') as f:
+            if f.read(len(cls.FILE_MAGIC)) != cls.FILE_MAGIC:
+                raise ValueError("not a saved invoice bloom filter")
+            capacity, num_bits, num_hashes, *version = cls.FILE_HEADER.unpack(f.read(cls.FILE_HEADER.size))
+            bits = bytearray(f.read())
+        if len(bits) != (num_bits + 7) // 8:
+            raise ValueError("truncated bit array")
+        bloom = cls.__new__(cls)
+        bloom.capacity, bloom.num_bits, bloom.num_hashes, bloom.bits = capacity, num_bits, num_hashes, bits
+        return bloom, tuple(version)
+
+    def _positions(self, value):
+        # Double hashing: k positions from the two halves of one 128-bit digest
+        digest = hashlib.blake2b(value.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return ((h1 + i * h2) % self.num_bits for i in range(self.num_hashes))
+
+    def add(self, value):
+        for pos in self._positions(value):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, value):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(value))
+
+def build_invoice_bloom(conn, min_capacity=1_000_000):
+    """Builds a BloomFilter holding every invoice number in the processed invoice store."""
+    count = conn.execute("SELECT COUNT(*) FROM inv").fetchone()[0]
+    bloom = BloomFilter(max(min_capacity, 2 * count)) # Room for growth before the error rate degrades
+    for (invoice_number,) in conn.execute("SELECT n FROM inv"):
+        bloom.add(invoice_number)
+    return bloom
+
+def invoice_store_version(conn):
+    """(row count, highest rowid) of the invoice store. Adding invoice numbers always changes it."""
+    return tuple(conn.execute("SELECT COUNT(*), COALESCE(MAX(rowid), 0) FROM inv").fetchone())
+
+def load_or_build_invoice_bloom(conn, bloom_path, min_capacity=1_000_000):
+    """
+    Returns the bloom filter saved at bloom_path if it was saved for the store as it is now
+    (and is not over capacity); otherwise builds a new one from the store.
+    """
+    version = invoice_store_version(conn)
     try:
-        with open(log_path, 'a', encoding='utf-8') as f:
-            f.write(str(invoice_number).strip() + '\n')
-    except Exception as e:
-        logging.error(f"Failed to append invoice number '{invoice_number}' to log file '{log_path}': {e}")
-        # This is problematic, as the invoice is processed but not logged. Manual check might be needed.
-        print(f"CRITICAL WARNING: Failed to log processed invoice '{invoice_number}' to '{log_path}'. Duplicate check may fail next time.")
+        bloom, saved_version = BloomFilter.load(bloom_path)
+        if saved_version == version and version[0] <= bloom.capacity:
+            print(f"Using saved invoice bloom filter '{bloom_path}'.")
+            return bloom
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError, struct.error) as e:
+        logging.warning(f"Could not read saved invoice bloom filter '{bloom_path}': {e}. Rebuilding it.")
+    print("Building invoice bloom filter from the processed invoice store...")
+    return build_invoice_bloom(conn, min_capacity)
+
+def save_invoice_bloom(conn, bloom, bloom_path):
+    """Saves the bloom filter for the next run. Call after the invoice store is committed."""
+    try:
+        bloom.save(bloom_path, invoice_store_version(conn))
+    except OSError as e:
+        # Only costs a rebuild next run
+        logging.warning(f"Could not save invoice bloom filter to '{bloom_path}': {e}")
 
+def invoice_in_log(conn, invoice_number, bloom=None):
+    """
+    Returns True if the invoice number is recorded in the processed invoice store.
+    With a bloom filter, numbers it has never seen are answered without querying SQLite.
+    """
+    if bloom is not None and invoice_number not in bloom:
+        return False
+    return conn.execute("SELECT 1 FROM inv WHERE n = ?", (invoice_number,)).fetchone() is not None
 
-def get_invoice_number_from_csv(csv_path, invoice_col_label):
-    """Reads the first data row of a CSV and returns the value from the 'Invoice Number' column."""
-    try:
-        with open(csv_path, 'r', newline='', encoding='utf-8') as csvfile:
-            reader = csv.reader(csvfile)
-            headers = next(reader, None) # Read header row
-            if not headers:
-                # print(f"Warning: CSV file has no headers: {csv_path}")
-                return None # Or raise error? Let's return None.
+class InvoiceLogWriter:
+    """
+    Records processed invoice numbers in the invoice store, committing once every
+    commit_every invoices (and on close) instead of once per invoice. Uncommitted
+    numbers are still seen by invoice_in_log on the same connection.
+    If audit_log_path is given, close() also appends the run's invoice numbers to that
+    plain-text log in a single write. Callers hold invoice_lock around add() and close().
+    """
+    def __init__(self, conn, commit_every=50, bloom=None, audit_log_path=None):
+        self.conn = conn
+        self.commit_every = commit_every
+        self.bloom = bloom # Kept in step with the store, if the bloom prefilter is enabled
+        self.audit_log_path = audit_log_path
+        self.pending = []
+        self.recorded = [] # Everything added this run, for the audit log
+
+    def add(self, invoice_number):
+        """Adds a successfully processed invoice number, committing when the batch is full."""
+        try:
+            invoice_number = str(invoice_number).strip()
+            self.conn.execute("INSERT OR IGNORE INTO inv VALUES(?)", (invoice_number,))
+            if self.bloom is not None:
+                self.bloom.add(invoice_number)
+            self.pending.append(invoice_number)
+            self.recorded.append(invoice_number)
+            if len(self.pending) >= self.commit_every:
+                self.flush()
+        except Exception as e:
+            logging.error(f"Failed to record invoice number '{invoice_number}' in the processed invoice store: {e}")
+            # This is problematic, as the invoice is processed but not logged. Manual check might be needed.
+            print(f"CRITICAL WARNING: Failed to log processed invoice '{invoice_number}'. Duplicate check may fail next time.")
+
+    def flush(self):
+        """Commits the invoice numbers added since the last commit."""
+        if not self.pending:
+            return
+        try:
+            self.conn.commit()
+            self.pending = []
+        except Exception as e:
+            logging.error(f"Failed to commit invoice numbers {self.pending} to the processed invoice store: {e}")
+            print(f"CRITICAL WARNING: Failed to log processed invoices {self.pending}. Duplicate check may fail next time.")
 
+    def close(self):
+        self.flush()
+        if self.audit_log_path and self.recorded:
             try:
-                invoice_col_index = headers.index(invoice_col_label)
-            except ValueError:
-                # print(f"Warning: Column '{invoice_col_label}' not found in CSV headers: {csv_path}")
-                logging.warning(f"Column '{invoice_col_label}' not found in CSV headers: {os.path.basename(csv_path)}")
-                return None # Column doesn't exist
-
-            first_data_row = next(reader, None) # Read first data row
-            if not first_data_row:
-                # print(f"Warning: CSV file has headers but no data rows: {csv_path}")
-                return None # No data to get invoice number from
-
-            if invoice_col_index < len(first_data_row):
-                invoice_num = first_data_row[invoice_col_index].strip()
-                return invoice_num if invoice_num else None # Return None if empty string
-            else:
-                # print(f"Warning: Data row is shorter than expected (missing invoice column data?): {csv_path}")
-                logging.warning(f"Data row shorter than expected in {os.path.basename(csv_path)}. Cannot get invoice number.")
-                return None
+                with open(self.audit_log_path, 'a', encoding='utf-8') as f:
+                    f.write(''.join(f"{n}\n" for n in self.recorded))
+                self.recorded = []
+            except Exception as e:
+                # The store is already committed, so duplicate checks are unaffected
+                logging.error(f"Failed to append processed invoice numbers to audit log '{self.audit_log_path}': {e}")
+
+
+def get_invoice_number_from_csv(csv_path, invoice_col_label, preparsed=None):
+    """
+    Reads the first data row of a CSV and returns the value from the 'Invoice Number' column.
+    preparsed is an optional (headers, data_rows) from read_small_csv, used instead of reading the file.
+    """
+    try:
+        if preparsed is None:
+            preparsed = read_small_csv(csv_path)
+        headers, data_rows = preparsed
+        if not headers:
+            # print(f"Warning: CSV file has no headers: {csv_path}")
+            return None # Or raise error? Let's return None.
+
+        try:
+            invoice_col_index = headers.index(invoice_col_label)
+        except ValueError:
+            # print(f"Warning: Column '{invoice_col_label}' not found in CSV headers: {csv_path}")
+            logging.warning(f"Column '{invoice_col_label}' not found in CSV headers: {os.path.basename(csv_path)}")
+            return None # Column doesn't exist
+
+        first_data_row = data_rows[0] if data_rows else None # First data row
+        if not first_data_row:
+            # print(f"Warning: CSV file has headers but no data rows: {csv_path}")
+            return None # No data to get invoice number from
+
+        if invoice_col_index < len(first_data_row):
+            invoice_num = first_data_row[invoice_col_index].strip()
+            return invoice_num if invoice_num else None # Return None if empty string
+        else:
+            # print(f"Warning: Data row is shorter than expected (missing invoice column data?): {csv_path}")
+            logging.warning(f"Data row shorter than expected in {os.path.basename(csv_path)}. Cannot get invoice number.")
+            return None
 
     except FileNotFoundError:
         # This shouldn't happen if called within the main loop's check, but handle defensively.
@@ -288,9 +761,19 @@ def get_invoice_number_from_csv(csv_path, invoice_col_label):
 
 # --- Processing Functions ---
 
-def setup_logging(log_file):
-    """Sets up logging to file and console based on LOGGING_LEVEL in .env."""
-    # --- Get Logging Level from .env ---
+_log_listener = None # QueueListener started by setup_logging
+
+def _stop_log_listener():
+    """Stops the logging QueueListener, flushing any queued records."""
+    global _log_listener
+    if _log_listener is not None:
+        _log_listener.stop()
+        _log_listener = None
+
+atexit.register(_stop_log_listener)
+
+def get_log_level():
+    """Returns (name, level) for LOGGING_LEVEL in .env; the uploader defaults to ERROR."""
     LOGGING_LEVEL_MAP = {
         'DEBUG': logging.DEBUG,
         'INFO': logging.INFO,
@@ -299,51 +782,61 @@ def setup_logging(log_file):
         'CRITICAL': logging.CRITICAL
     }
     log_level_str = os.getenv('LOGGING_LEVEL', 'ERROR').upper() # Default to ERROR for uploader
-    log_level = LOGGING_LEVEL_MAP.get(log_level_str, logging.ERROR)
+    return log_level_str, LOGGING_LEVEL_MAP.get(log_level_str, logging.ERROR)
+
+def setup_logging(log_file):
+    """Sets up logging to file and console based on LOGGING_LEVEL in .env."""
+    # --- Get Logging Level from .env ---
+    log_level_str, log_level = get_log_level()
     print(f"Setting Grist Uploader log level to: {log_level_str} ({log_level})") # Info print
 
-    logging.basicConfig(
-        level=log_level, # Use level from .env
-        format='%(asctime)s - %(levelname)s - %(message)s',
-        filename=log_file,
-        filemode='a' # Append to the log file
-    )
-    # Also add a handler to print to console, using the same level
+    # File and console handlers run on a QueueListener thread, so logging calls from the
+    # upload threads only enqueue the record and never block on disk or console I/O
+    global _log_listener
+    formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+    file_handler = logging.FileHandler(log_file, mode='a') # Append to the log file
+    file_handler.setFormatter(formatter)
     console_handler = logging.StreamHandler()
     console_handler.setLevel(log_level) # Use level from .env
-    formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
     console_handler.setFormatter(formatter)
-    # Make sure not to add duplicate handlers if script is re-run in some way
+
     root_logger = logging.getLogger('')
-    # Remove existing StreamHandlers if any before adding new one
+    root_logger.setLevel(log_level) # Use level from .env
+    # Make sure not to add duplicate handlers if script is re-run in some way
     for handler in root_logger.handlers[:]:
-        if isinstance(handler, logging.StreamHandler):
+        if isinstance(handler, (logging.StreamHandler, logging.handlers.QueueHandler)):
             root_logger.removeHandler(handler)
-    root_logger.addHandler(console_handler)
+    _stop_log_listener()
 
+    log_queue = queue.Queue(-1)
+    root_logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    _log_listener = logging.handlers.QueueListener(log_queue, file_handler, console_handler, respect_handler_level=True)
+    _log_listener.start()
 
-def upload_csv_to_grist(csv_file_path, table_id, uploader, grist_columns_data):
-    """Handles reading, mapping, and uploading a single CSV to a Grist table."""
-    print(f"Attempting to upload: {os.path.basename(csv_file_path)} to table {table_id}")
 
-    # Extract CSV headers
+def upload_csv_to_grist(csv_file_path, table_id, uploader, column_lookup, preparsed=None):
+    """
+    Handles reading, mapping, and uploading a single CSV to a Grist table.
+    preparsed is an optional (headers, data_rows) already read with read_small_csv.
+    """
+    base_name = os.path.basename(csv_file_path) # Used in every message below
+    print(f"Attempting to upload: {base_name} to table {table_id}")
+
+    # Read CSV headers and peek at the first data row; the same open file then feeds the upload
     try:
-        with open(csv_file_path, 'r', newline='', encoding='utf-8') as csvfile:
-            reader = csv.reader(csvfile)
-            try:
-                csv_headers = next(reader)
-                # Check if there's at least one data row by trying to read it
-                first_row = next(reader, None)
-                if first_row is None and not csv_headers: # Completely empty file
-                     print(f"Skipping empty file (no headers, no data): {os.path.basename(csv_file_path)}")
-                     return True # Treat as success (nothing to upload)
-                if first_row is None:
-                     print(f"Skipping file with only headers: {os.path.basename(csv_file_path)}")
-                     return True # Treat as success (nothing to upload)
-                # print(f"CSV Headers for {os.path.basename(csv_file_path)}: {csv_headers}") # Debug
-            except StopIteration:
-                print(f"Skipping empty file (StopIteration): {os.path.basename(csv_file_path)}")
-                return True # Treat as success
+        if preparsed is not None:
+            csv_headers, rows = preparsed[0], (row for row in preparsed[1])
+        else:
+            csv_headers, rows = iter_csv_records(csv_file_path)
+        if not csv_headers: # Completely empty file
+             print(f"Skipping empty file (no headers, no data): {base_name}")
+             return True # Treat as success (nothing to upload)
+        # Check if there's at least one data row by trying to read it
+        first_row = next(rows, None)
+        if first_row is None:
+             print(f"Skipping file with only headers: {base_name}")
+             return True # Treat as success (nothing to upload)
+        # print(f"CSV Headers for {base_name}: {csv_headers}") # Debug
     except FileNotFoundError:
          print(f"Error: File not found before reading headers: {csv_file_path}")
          raise # Propagate error
@@ -353,79 +846,314 @@ def upload_csv_to_grist(csv_file_path, table_id, uploader, grist_columns_data):
 
 
     # Generate mapping
-    column_mapping = create_column_mapping_from_grist(grist_columns_data, csv_headers)
+    column_mapping = create_column_mapping_from_grist(column_lookup, csv_headers)
     if not column_mapping:
-         print(f"Warning: No column mapping generated for {os.path.basename(csv_file_path)}. Check CSV headers and Grist columns.")
+         rows.close()
+         print(f"Warning: No column mapping generated for {base_name}. Check CSV headers and Grist columns.")
          # Decide if this is an error or just a skip. Let's treat as skippable success for now.
          return True
 
-    # Read CSV data
-    records = read_csv_to_records(csv_file_path, column_mapping)
-    if not records:
-        print(f"No data records found or mapped in {os.path.basename(csv_file_path)}.")
+    # Upload records in batches, streaming them from the CSV as they are read
+    batch_size = max(1, int(os.getenv('GRIST_BATCH_SIZE', '1000'))) # 0 or less would send no batches at all
+    # Batches in flight at once over the shared session. The default of 1 keeps rows in CSV order
+    # and stops at the first failed batch; higher values are opt-in and can leave several batches
+    # of a failed file uploaded (they are sent again on the next run)
+    max_in_flight = int(os.getenv('GRIST_UPLOAD_CONCURRENCY', '1'))
+    print(f"Uploading records from {base_name} in batches of {batch_size}...")
+    logging.info(f"Effective batch size {batch_size} ({max_in_flight} in flight) for {base_name}")
+
+    pandas_threshold = int(os.getenv('PANDAS_THRESHOLD', '52428800')) # 50 MB
+    if preparsed is None and pd is not None and os.path.getsize(csv_file_path) > pandas_threshold:
+        rows.close()
+        print(f"Large file, parsing {base_name} with pandas...")
+        records = itertools.chain.from_iterable(read_csv_chunks_pandas(csv_file_path, column_mapping, batch_size))
+    else:
+        records = rows_to_records(csv_headers, itertools.chain([first_row], rows), column_mapping)
+    if os.getenv('GRIST_DEDUPE', '0') == '1':
+        records = dedupe_records(records)
+    try:
+        total_records_in_file = upload_batches(uploader, table_id, chunked(records, batch_size), max_in_flight)
+    except Exception as e:
+        # Error during batch upload - log and signal failure for the whole file
+        print(f"Error uploading batch for {base_name}: {e}")
+        # Log detailed error if possible (e.g., response content from HTTPError)
+        if isinstance(e, requests.exceptions.HTTPError) and e.response is not None:
+             logging.error(f"Grist upload failed for {base_name} (Table: {table_id}). Status: {e.response.status_code}. Response: {e.response.text}")
+        else:
+             logging.error(f"Grist upload failed for {base_name} (Table: {table_id}). Error: {e}\n{traceback.format_exc()}")
+        return False # Indicate failure for this file
+    finally:
+        rows.close() # Releases the CSV file even if the upload stopped part way
+
+    if not total_records_in_file:
+        print(f"No data records found or mapped in {base_name}.")
         return True # Treat as success (nothing to upload)
 
-    # Upload records in batches
-    batch_size = 100 # Consider making this configurable via .env if needed
-    total_records_in_file = len(records)
-    print(f"Uploading {total_records_in_file} records from {os.path.basename(csv_file_path)} in batches of {batch_size}...")
+    print(f"Successfully uploaded {total_records_in_file} records from {base_name}.")
+    return True # Indicate success for this file
+
 
-    for i in range(0, total_records_in_file, batch_size):
-        batch = records[i:i+batch_size]
+def records_to_actions(table_id, records):
+    """
+    Turns records into Grist user actions: one column-oriented BulkAddRecord when every
+    record has the same fields (the usual case), else one AddRecord per record.
+    """
+    field_names = records[0]["fields"].keys()
+    if all(record["fields"].keys() == field_names for record in records):
+        columns = {name: [record["fields"][name] for record in records] for name in field_names}
+        return [["BulkAddRecord", table_id, [None] * len(records), columns]]
+    return [["AddRecord", table_id, None, record["fields"]] for record in records]
+
+class ApplyBatcher:
+    """
+    Combines the /apply actions of pairs that worker threads upload at about the same time
+    into one request. The first pair to arrive waits up to `wait` seconds (or until
+    max_pairs pairs are queued) and sends the batch; the others block until it is done.
+    If Grist refuses the combined request (a 4xx, so nothing was written), each pair is
+    re-sent on its own by its own thread, so one bad pair doesn't fail the rest. Any other
+    failure (5xx, timeout, dropped connection) may have been committed, so every pair in
+    the batch fails with that error instead. apply_actions() behaves like GristUploader's.
+    """
+    def __init__(self, uploader, max_pairs, wait=0.05):
+        self.uploader = uploader
+        self.max_pairs = max_pairs
+        self.wait = wait
+        self._cond = threading.Condition()
+        self._pending = []
+
+    def apply_actions(self, actions):
+        entry = {'actions': actions, 'done': threading.Event(), 'combined': False, 'error': None}
+        with self._cond:
+            self._pending.append(entry)
+            leader = len(self._pending) == 1
+            if len(self._pending) >= self.max_pairs:
+                self._cond.notify_all()
+        if leader:
+            with self._cond:
+                self._cond.wait_for(lambda: len(self._pending) >= self.max_pairs, timeout=self.wait)
+                batch, self._pending = self._pending, []
+            self._send(batch)
+        entry['done'].wait()
+        if entry['error'] is not None:
+            raise entry['error']
+        if not entry['combined']:
+            self.uploader.apply_actions(actions)
+
+    def _send(self, batch):
         try:
-            result = uploader.add_records(table_id, batch)
-            # print(f"Uploaded batch {i // batch_size + 1}/{(total_records_in_file + batch_size - 1) // batch_size} for {os.path.basename(csv_file_path)}") # Debug
+            if len(batch) > 1:
+                self.uploader.apply_actions([action for entry in batch for action in entry['actions']])
+                for entry in batch:
+                    entry['combined'] = True
+                print(f"Uploaded {len(batch)} pairs in one request.")
         except Exception as e:
-            # Error during batch upload - log and signal failure for the whole file
-            print(f"Error uploading batch for {os.path.basename(csv_file_path)}: {e}")
-            # Log detailed error if possible (e.g., response content from HTTPError)
-            if isinstance(e, requests.exceptions.HTTPError) and e.response is not None:
-                 logging.error(f"Grist upload failed for {os.path.basename(csv_file_path)} (Table: {table_id}). Status: {e.response.status_code}. Response: {e.response.text}")
+            response = getattr(e, 'response', None)
+            if isinstance(e, requests.exceptions.HTTPError) and response is not None and 400 <= response.status_code < 500:
+                logging.error(f"Grist refused the combined upload of {len(batch)} pairs. Status: {response.status_code}. Response: {response.text}. Uploading them one by one.")
             else:
-                 logging.error(f"Grist upload failed for {os.path.basename(csv_file_path)} (Table: {table_id}). Error: {e}\n{traceback.format_exc()}")
-            return False # Indicate failure for this file
+                logging.error(f"Combined upload of {len(batch)} pairs failed: {e}. Not re-sending them, as it may already have been applied.")
+                for entry in batch:
+                    entry['error'] = e
+        finally:
+            for entry in batch:
+                entry['done'].set()
+
+def upload_pair_with_apply(uploader, header_path, header_csv, header_table_id, header_lookup,
+                           items_path, items_table_id, items_lookup, apply_batcher=None):
+    """
+    Uploads a small Header/Items pair with a single /apply request, so both tables are
+    written in one Grist transaction. Returns True/False like upload_csv_to_grist, or
+    None if Grist refused the request as too large (413) and the pair should be
+    uploaded file by file instead. With an apply_batcher, the request may be shared
+    with other pairs.
+    """
+    actions = []
+    for csv_path, (csv_headers, rows), table_id, column_lookup in (
+            (header_path, header_csv, header_table_id, header_lookup),
+            (items_path, read_small_csv(items_path), items_table_id, items_lookup)):
+        base_name = os.path.basename(csv_path)
+        if not csv_headers or not rows:
+            print(f"Skipping file with no data rows: {base_name}")
+            continue
+        column_mapping = create_column_mapping_from_grist(column_lookup, csv_headers)
+        if not column_mapping:
+            print(f"Warning: No column mapping generated for {base_name}. Check CSV headers and Grist columns.")
+            continue
+        records = rows_to_records(csv_headers, rows, column_mapping)
+        if os.getenv('GRIST_DEDUPE', '0') == '1':
+            records = dedupe_records(records)
+        records = list(records)
+        if records:
+            actions.extend(records_to_actions(table_id, records))
+
+    if not actions:
+        print(f"No data records found or mapped in {os.path.basename(header_path)} or {os.path.basename(items_path)}.")
+        return True # Treat as success (nothing to upload)
 
-    print(f"Successfully uploaded {total_records_in_file} records from {os.path.basename(csv_file_path)}.")
-    return True # Indicate success for this file
+    try:
+        (apply_batcher or uploader).apply_actions(actions)
+    except requests.exceptions.HTTPError as e:
+        if e.response is not None and e.response.status_code == 413:
+            print(f"Combined upload of {os.path.basename(header_path)} and {os.path.basename(items_path)} is too large. Uploading the files separately.")
+            return None
+        logging.error(f"Grist apply failed for {os.path.basename(header_path)} and {os.path.basename(items_path)}. Status: {e.response.status_code if e.response is not None else 'n/a'}. Response: {e.response.text if e.response is not None else e}")
+        return False
+    except Exception as e:
+        logging.error(f"Grist apply failed for {os.path.basename(header_path)} and {os.path.basename(items_path)}. Error: {e}\n{traceback.format_exc()}")
+        return False
+    print(f"Successfully uploaded {os.path.basename(header_path)} and {os.path.basename(items_path)} in one request.")
+    return True
+
+def upload_batches(uploader, table_id, batches, max_in_flight):
+    """
+    Uploads batches of records to a Grist table, keeping up to max_in_flight
+    requests in flight at once. Returns the number of records uploaded and
+    raises on the first batch that fails.
+    """
+    uploaded = 0
+    if max_in_flight <= 1:
+        for batch in batches:
+            uploaded += add_batch_splitting_on_413(uploader, table_id, batch)
+        return uploaded
 
+    def add_batch(batch):
+        return add_batch_splitting_on_413(uploader, table_id, batch)
+
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        pending = set()
+        try:
+            for batch in batches:
+                if len(pending) >= max_in_flight:
+                    # Wait for a slot so only max_in_flight batches are held at once
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    uploaded += sum(future.result() for future in done)
+                pending.add(executor.submit(add_batch, batch))
+            done, pending = wait(pending)
+            uploaded += sum(future.result() for future in done)
+        except Exception:
+            for future in pending:
+                future.cancel()
+            raise
+    return uploaded
+
+
+def add_batch_splitting_on_413(uploader, table_id, batch):
+    """
+    Adds one batch of records. If Grist rejects the payload as too large (413),
+    the batch is halved and each half retried. Returns the number of records added.
+    """
+    try:
+        uploader.add_records(table_id, batch)
+    except requests.exceptions.HTTPError as e:
+        if e.response is None or e.response.status_code != 413 or len(batch) <= 1:
+            raise
+        half = len(batch) // 2
+        logging.warning(f"Grist rejected a batch of {len(batch)} records for table {table_id} as too large (413). Retrying in batches of {half}.")
+        add_batch_splitting_on_413(uploader, table_id, batch[:half])
+        add_batch_splitting_on_413(uploader, table_id, batch[half:])
+    return len(batch)
+
+
+@functools.lru_cache(maxsize=None)
+def ensure_month_dir(month_year_dir):
+    """Creates a Month-Year success subdirectory once per run; later calls for it are free."""
+    os.makedirs(month_year_dir, exist_ok=True)
+
+def success_dest_path(source_path, month_year_dir):
+    """Returns where a CSV goes in a Month-Year success folder: same name with a .success extension."""
+    name_part, _ = os.path.splitext(os.path.basename(source_path))
+    return os.path.join(month_year_dir, f"{name_part}.success")
+
+def move_file(source_path, dest_path):
+    """
+    Moves a file with a single rename. Only when the destination is on another filesystem
+    (EXDEV) does it fall back to shutil.move's copy+delete; any other error is raised.
+    """
+    try:
+        os.replace(source_path, dest_path)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        shutil.move(source_path, dest_path)
 
-def move_and_rename_file(source_path, base_success_dir):
+def move_and_rename_file(source_path, base_success_dir, month_year_str=None):
     """
     Moves a file to a Month-Year subdirectory within the base success directory
-    and renames its extension to .success.
+    and renames its extension to .success. main() passes month_year_str once per run.
     """
     if not os.path.exists(source_path):
         print(f"Warning: Source file not found for moving: {source_path}")
         return False # Indicate failure
 
+    # 1. Determine Month-Year subdirectory
+    if month_year_str is None:
+        month_year_str = datetime.now().strftime("%b-%y") # e.g., Apr-25
+    month_year_dir = os.path.join(base_success_dir, month_year_str)
     try:
-        # 1. Determine Month-Year subdirectory
-        now = datetime.now()
-        month_year_str = now.strftime("%b-%y") # e.g., Apr-25
-        month_year_dir = os.path.join(base_success_dir, month_year_str)
-
         # 2. Ensure Month-Year subdirectory exists
-        os.makedirs(month_year_dir, exist_ok=True)
+        ensure_month_dir(month_year_dir)
 
         # 3. Define destination filename and path
         base_filename = os.path.basename(source_path)
-        name_part, _ = os.path.splitext(base_filename)
-        dest_filename = f"{name_part}.success"
-        dest_path = os.path.join(month_year_dir, dest_filename) # Path inside Month-Year dir
+        dest_path = success_dest_path(source_path, month_year_dir) # Path inside Month-Year dir
+        dest_filename = os.path.basename(dest_path)
 
-        # 4. Move the file
-        shutil.move(source_path, dest_path)
+        # 4. Move the file - a single rename when on the same filesystem (the usual case,
+        #    since the success folder lives inside the CSV folder), copy+delete otherwise
+        move_file(source_path, dest_path)
         print(f"Successfully moved and renamed {base_filename} to {dest_filename} in {month_year_dir}")
         return True
     except Exception as e:
         # Log error with the intended destination path for clarity
         # Construct intended path again for logging, in case error happened before dest_path was set
-        intended_dest_dir = os.path.join(base_success_dir, datetime.now().strftime("%b-%y"))
-        intended_dest_filename = f"{os.path.splitext(os.path.basename(source_path))[0]}.success"
-        intended_dest_path = os.path.join(intended_dest_dir, intended_dest_filename)
+        intended_dest_path = success_dest_path(source_path, month_year_dir)
         logging.error(f"Failed to move/rename {os.path.basename(source_path)} to {intended_dest_path}. Error: {e}\n{traceback.format_exc()}")
         return False
 
+def move_pair_to_success(header_path, items_path, base_success_dir, month_year_str):
+    """
+    Moves a Header/Items pair to the success folder as a unit. If the Items file cannot
+    be moved, the Header file is moved back, so the pair is never left half-moved.
+    """
+    if not move_and_rename_file(header_path, base_success_dir, month_year_str):
+        return False
+    if move_and_rename_file(items_path, base_success_dir, month_year_str):
+        return True
+    header_dest = success_dest_path(header_path, os.path.join(base_success_dir, month_year_str))
+    try:
+        move_file(header_dest, header_path)
+        print(f"Moved {os.path.basename(header_path)} back after {os.path.basename(items_path)} could not be moved.")
+    except OSError as e:
+        logging.error(f"Failed to move {header_dest} back to {header_path} after the items file move failed. Error: {e}")
+    return False
+
+def list_success_dirs(base_success_dir):
+    """
+    Returns the success directory and its Month-Year subdirectories: the places a pair's
+    .success files can be. Reads only the top level, not the files inside each month.
+    """
+    success_dirs = [base_success_dir]
+    try:
+        with os.scandir(base_success_dir) as entries:
+            success_dirs.extend(entry.path for entry in entries if entry.is_dir())
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        logging.error(f"Could not scan success directory '{base_success_dir}' for Month-Year folders. Error: {e}")
+    return success_dirs
+
+def find_success_markers(prefix, success_dirs):
+    """
+    Returns the directory holding both {prefix}_Header.success and {prefix}_Items.success
+    (the pair was uploaded and moved in an earlier run), or None. A couple of stat calls
+    per directory, so the cost does not grow with the number of files already moved.
+    """
+    for success_dir in success_dirs:
+        if (os.path.exists(os.path.join(success_dir, f"{prefix}_Header.success")) and
+                os.path.exists(os.path.join(success_dir, f"{prefix}_Items.success"))):
+            return success_dir
+    return None
+
 def move_and_rename_duplicate(source_path, rejected_dir):
     """Moves a file to the rejected directory and renames it with a _duplicate suffix."""
     if not os.path.exists(source_path):
@@ -441,7 +1169,8 @@ def move_and_rename_duplicate(source_path, rejected_dir):
     try:
         # Ensure rejected directory exists
         os.makedirs(rejected_dir, exist_ok=True)
-        shutil.move(source_path, dest_path)
+        # A single atomic rename on the same filesystem (the Rejected folder sits in the CSV folder)
+        move_file(source_path, dest_path)
         print(f"Moved duplicate file {base_filename} to {dest_filename} in {rejected_dir}")
         return True
     except Exception as e:
@@ -450,11 +1179,167 @@ def move_and_rename_duplicate(source_path, rejected_dir):
         return False
 
 
-def main():
-    # --- Configuration ---
+def find_csv_pairs(csv_directory_path):
+    """
+    Scans the CSV directory once and returns (pairs, prefix_count): the sorted list of
+    (prefix, header_path, items_path) for every prefix with both a _Header.csv and an
+    _Items.csv file, and the number of distinct prefixes seen. Pairs are completed during
+    the scan, and scandir entries carry their type and full path, so there is no second
+    pass and no extra stat per file. The directory is fully read before any pair is
+    processed, since processing moves files out of it.
+    """
+    seen = {} # prefix -> the one file of the pair found so far, as (kind, path)
+    pairs = []
+    with os.scandir(csv_directory_path) as entries:
+        for entry in entries:
+            prefix, sep, kind = entry.name.rpartition('_')
+            if not (sep and kind in ('Header.csv', 'Items.csv') and entry.is_file()):
+                continue
+            other = seen.setdefault(prefix, (kind, entry.path))
+            if other[0] != kind: # Second half of the pair
+                header_path, items_path = (other[1], entry.path) if kind == 'Items.csv' else (entry.path, other[1])
+                pairs.append((prefix, header_path, items_path))
+    pairs.sort() # Consistent submission order
+    return pairs, len(seen)
+
+def process_pair(prefix, header_path, items_path, uploader, header_table_id, items_table_id,
+                 header_lookup, items_lookup, success_dir_path, month_year_str, rejected_dir_path,
+                 invoice_db, invoice_bloom, invoice_log_writer, reserved_invoice_numbers, invoice_lock, log_file_name,
+                 apply_batcher=None):
+    """
+    Checks a Header/Items pair for a duplicate invoice, uploads both files and moves them.
+    Returns 'success', 'duplicate' or 'failed'. Runs on worker threads, so the invoice store
+    and the set of invoices reserved by this run are only touched while holding invoice_lock.
+    """
+    header_filename = os.path.basename(header_path)
+    items_filename = os.path.basename(items_path)
+    print(f"\n--- Processing Pair: {prefix} ---")
+    header_success = False
+    items_success = False
+    invoice_number = None # Initialize
+
+    # 0. Check for Duplicates using the log file
+    try:
+        # The Header CSV is small: read it once for both the duplicate check and the upload
+        header_csv = read_small_csv(header_path)
+        invoice_number = get_invoice_number_from_csv(header_path, INVOICE_NUMBER_COLUMN_LABEL, preparsed=header_csv)
+        if invoice_number is None:
+            print(f"Warning: Could not read Invoice Number from {header_filename}. Skipping this pair.")
+            logging.warning(f"Could not read Invoice Number from {header_filename} for prefix '{prefix}'. Skipping.")
+            return 'failed'
+
+        with invoice_lock:
+            # Checking and reserving under one lock stops two threads uploading the same invoice
+            is_duplicate = invoice_number in reserved_invoice_numbers or invoice_in_log(invoice_db, invoice_number, invoice_bloom)
+            if not is_duplicate:
+                reserved_invoice_numbers.add(invoice_number)
+        if is_duplicate:
+            print(f"Duplicate detected: Invoice Number '{invoice_number}' from file {header_filename} already processed. Moving to Rejected folder.")
+            # Move both files to Rejected folder with _duplicate suffix
+            moved_header_dup = move_and_rename_duplicate(header_path, rejected_dir_path)
+            moved_items_dup = move_and_rename_duplicate(items_path, rejected_dir_path)
+            if not moved_header_dup or not moved_items_dup:
+                 # Log that the move failed, files might remain in source
+                 logging.error(f"Failed to move one or both duplicate files for prefix '{prefix}' (Invoice: {invoice_number}) to Rejected folder.")
+            # Counted separately from failures
+            return 'duplicate'
+
+    except Exception as e:
+         print(f"Error checking for duplicate invoice number in {header_filename}: {e}. Skipping this pair.")
+         logging.error(f"Error checking duplicate for prefix '{prefix}' ({header_filename}): {e}\n{traceback.format_exc()}")
+         return 'failed'
+
+
+    # --- If not a duplicate, proceed with upload ---
+    print(f"Invoice Number '{invoice_number}' not found in log. Proceeding with upload...")
+
+    # Small pairs go up in a single /apply request (one round trip, one Grist transaction);
+    # larger ones, or pairs Grist refuses as too large, are uploaded file by file in batches
+    pair_uploaded = None
+    apply_max_bytes = int(os.getenv('GRIST_APPLY_MAX_BYTES', '262144')) # 0 disables the combined upload
+    if apply_max_bytes:
+        try:
+            if os.path.getsize(items_path) <= apply_max_bytes:
+                pair_uploaded = upload_pair_with_apply(uploader, header_path, header_csv, header_table_id, header_lookup,
+                                                       items_path, items_table_id, items_lookup, apply_batcher)
+        except Exception as e:
+            logging.error(f"Unexpected error uploading pair '{prefix}': {e}\n{traceback.format_exc()}")
+            pair_uploaded = False
+    if pair_uploaded is not None:
+        header_success = items_success = pair_uploaded
+    else:
+        # 1. Process Header File
+        try:
+            header_success = upload_csv_to_grist(header_path, header_table_id, uploader, header_lookup, preparsed=header_csv)
+        except Exception as e:
+            if not isinstance(e, (requests.exceptions.RequestException, FileNotFoundError)):
+                 logging.error(f"Unexpected error processing header file {header_filename}: {e}\n{traceback.format_exc()}")
+            header_success = False
+
+        # 2. Process Items File (only if header was successful)
+        if header_success:
+            try:
+                items_success = upload_csv_to_grist(items_path, items_table_id, uploader, items_lookup)
+            except Exception as e:
+                if not isinstance(e, (requests.exceptions.RequestException, FileNotFoundError)):
+                     logging.error(f"Unexpected error processing items file {items_filename}: {e}\n{traceback.format_exc()}")
+                items_success = False
+        else:
+             print(f"Skipping items file {items_filename} because header processing failed.")
+             items_success = False
+
+    # 3. Move files and Update Log if BOTH succeeded
+    if header_success and items_success:
+        print(f"Both uploads successful for prefix '{prefix}'. Moving files...")
+        if move_pair_to_success(header_path, items_path, success_dir_path, month_year_str):
+            # Add to the invoice store (already reserved in memory since the duplicate check)
+            with invoice_lock:
+                invoice_log_writer.add(invoice_number)
+            print(f"Successfully processed, moved, and logged pair: {prefix} (Invoice: {invoice_number})")
+            return 'success'
+        else:
+            # CRITICAL: Uploads succeeded but move failed. Invoice is NOT logged.
+            logging.error(f"Uploads succeeded for '{prefix}' (Invoice: {invoice_number}), but failed to move one or both files. INVOICE NOT LOGGED AS PROCESSED. Please check manually.")
+            print(f"CRITICAL WARNING: Uploads succeeded for '{prefix}' but move failed. Invoice '{invoice_number}' was NOT logged. Manual check required.")
+    else:
+        print(f"Processing failed for pair '{prefix}'. Files will not be moved. Invoice '{invoice_number}' not logged. Check '{log_file_name}' for details.")
+
+    # Not logged as processed, so release the reservation made at the duplicate check
+    with invoice_lock:
+        reserved_invoice_numbers.discard(invoice_number)
+    return 'failed'
+
+
+def main(configure_logging=True, stop_event=None):
+    """
+    Uploads every complete Header/Items pair in the CSV directory once. Returns a Counter
+    of pair outcomes ('success', 'duplicate', 'failed', 'skipped', 'stopped'), or None if it
+    could not start. Safe to call repeatedly in one process; wrapper.py does so with
+    configure_logging=False so its own log handlers are left in place. This module's messages
+    still go to LOG_FILE_NAME at LOGGING_LEVEL, through a handler attached for the length of the run.
+    Once stop_event (a threading.Event) is set, pairs not yet started are left for the next run.
+    """
     log_file_name = os.getenv('LOG_FILE_NAME', 'upload_errors.log')
-    setup_logging(log_file_name)
+    if configure_logging:
+        setup_logging(log_file_name)
+        return run_uploads(log_file_name, stop_event)
+
+    file_handler = logging.FileHandler(log_file_name, mode='a', encoding='utf-8')
+    file_handler.setLevel(get_log_level()[1])
+    file_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+    # Only this module's records: the host application logs to the same root logger
+    file_handler.addFilter(lambda record: record.module == __name__.rpartition('.')[2])
+    root_logger = logging.getLogger('')
+    root_logger.addHandler(file_handler)
+    try:
+        return run_uploads(log_file_name, stop_event)
+    finally:
+        root_logger.removeHandler(file_handler)
+        file_handler.close()
 
+def run_uploads(log_file_name, stop_event=None):
+    """One upload pass over the CSV directory; see main()."""
+    # --- Configuration ---
     doc_id = os.getenv('GRIST_DOC_ID')
     header_table_id = os.getenv('GRIST_TABLE_ID')
     items_table_id = os.getenv('GRIST_ITEMS_TABLE_ID')
@@ -493,13 +1378,21 @@ def main():
     print(f"Success Folder: {success_dir_path}")
     print(f"Rejected Folder: {rejected_dir_path}") # Print new folder path
     print(f"Log File: {log_file_name}")
-    processed_log_path = os.path.join(csv_directory_path, PROCESSED_INVOICES_LOG_FILENAME)
+    processed_log_path = os.path.join(csv_directory_path, PROCESSED_INVOICES_DB_FILENAME)
+    legacy_log_path = os.path.join(csv_directory_path, PROCESSED_INVOICES_LOG_FILENAME)
+    audit_log_path = os.path.join(csv_directory_path, PROCESSED_INVOICES_AUDIT_FILENAME)
     print(f"Processed Invoice Log: {processed_log_path}")
 
 
+    # Number of file pairs processed concurrently
+    max_workers = int(os.getenv('MAX_WORKERS', '8'))
+
     # --- Initialize Grist Uploader ---
     try:
-        uploader = GristUploader(doc_id)
+        # Pool at least one connection per concurrent request (pair workers x batches each has in flight)
+        # so workers don't open throwaway connections
+        upload_concurrency = max(1, int(os.getenv('GRIST_UPLOAD_CONCURRENCY', '1')))
+        uploader = GristUploader(doc_id, pool_maxsize=max(16, max_workers * upload_concurrency))
     except ValueError as e:
         logging.error(f"Failed to initialize Grist Uploader: {e}. Exiting.")
         return
@@ -507,157 +1400,143 @@ def main():
          logging.error(f"An unexpected error occurred during Grist Uploader initialization: {e}\n{traceback.format_exc()}. Exiting.")
          return
 
-    # --- Pre-fetch Grist Column Info (reduces API calls) ---
-    try:
-        print("Getting Grist column info for Header table...")
-        header_columns_data = uploader.get_table_columns(header_table_id)
-        print("Getting Grist column info for Items table...")
-        items_columns_data = uploader.get_table_columns(items_table_id)
-    except Exception as e:
-        logging.error(f"Failed to get Grist column information. Check API key, Doc ID, Table IDs, and network connection. Error: {e}\n{traceback.format_exc()}. Exiting.")
-        return
+    # Session (and its pooled connections) is closed when processing ends
+    with uploader:
+        # --- Pre-fetch Grist Column Info (reduces API calls) ---
+        # Cached next to the log file and revalidated by ETag, so unchanged schemas skip the download
+        columns_cache_path = os.path.join(os.path.dirname(os.path.abspath(log_file_name)), COLUMNS_CACHE_FILENAME)
+        columns_cache = load_columns_cache(columns_cache_path)
+        try:
+            # The two tables are independent, so both requests go out at once (they update different cache keys)
+            print("Getting Grist column info for Header and Items tables...")
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                header_columns_future = executor.submit(uploader.get_table_columns, header_table_id, cache=columns_cache)
+                items_columns_future = executor.submit(uploader.get_table_columns, items_table_id, cache=columns_cache)
+                header_columns_data = header_columns_future.result()
+                items_columns_data = items_columns_future.result()
+            save_columns_cache(columns_cache_path, columns_cache)
+            # Header matching work is the same for every CSV, so do it once per table
+            header_lookup = build_lookup(header_columns_data)
+            items_lookup = build_lookup(items_columns_data)
+        except Exception as e:
+            logging.error(f"Failed to get Grist column information. Check API key, Doc ID, Table IDs, and network connection. Error: {e}\n{traceback.format_exc()}. Exiting.")
+            return
 
-    # --- Load or Create Processed Invoice Log ---
-    try:
-        processed_invoice_numbers = load_or_create_invoice_log(
-            processed_log_path, uploader, header_table_id, INVOICE_NUMBER_COLUMN_LABEL
+        # --- Load or Create Processed Invoice Log ---
+        try:
+            invoice_db = load_or_create_invoice_log(
+                processed_log_path, legacy_log_path, uploader, header_table_id, header_lookup, INVOICE_NUMBER_COLUMN_LABEL
+            )
+        except Exception as e:
+            # Errors during log loading/creation are logged within the functions
+            logging.critical(f"Failed to load or create the processed invoice log '{processed_log_path}'. Cannot proceed safely with duplicate checks. Exiting. Error: {e}")
+            print(f"CRITICAL: Failed to initialize invoice log. Exiting.")
+            return
+
+
+        # --- Find and Pair Files ---
+        # Only pairs where BOTH files exist in the source directory are processed
+        found_pairs, prefix_count = find_csv_pairs(csv_directory_path)
+        print(f"Found {prefix_count} unique file prefixes.")
+
+        # --- Process Paired Files ---
+        outcomes = collections.Counter() # 'success' / 'duplicate' / 'failed' / 'skipped' per pair, tallied as pairs finish
+
+        # A pair whose Header and Items files were both moved to Success in an earlier run is not
+        # uploaded again: it is rejected if its invoice is recorded as processed, and otherwise left
+        # in place for a manual check (it may be a legitimate re-export under the same name)
+        success_dirs = list_success_dirs(success_dir_path)
+
+        pairs = []
+        for prefix, header_path, items_path in found_pairs:
+            marker_dir = find_success_markers(prefix, success_dirs)
+            if marker_dir is None:
+                pairs.append((prefix, header_path, items_path))
+                continue
+            invoice_number = get_invoice_number_from_csv(header_path, INVOICE_NUMBER_COLUMN_LABEL)
+            if invoice_number is not None and invoice_in_log(invoice_db, invoice_number):
+                print(f"Pair '{prefix}' already has .success files in {marker_dir} and invoice '{invoice_number}' is processed. Moving to Rejected folder.")
+                outcomes['duplicate'] += 1
+                moved_header_dup = move_and_rename_duplicate(header_path, rejected_dir_path)
+                moved_items_dup = move_and_rename_duplicate(items_path, rejected_dir_path)
+                if not moved_header_dup or not moved_items_dup:
+                    logging.error(f"Failed to move one or both already-uploaded files for prefix '{prefix}' to Rejected folder.")
+            else:
+                print(f"Skipping pair '{prefix}': it has .success files in {marker_dir}, but invoice '{invoice_number}' is not recorded as processed. Check it and rename the files to upload them.")
+                logging.warning(f"Skipped pair '{prefix}' with existing .success files in {marker_dir}; invoice '{invoice_number}' is not in the processed invoice store.")
+                outcomes['skipped'] += 1
+
+        # Optional in-memory prefilter for very large invoice histories: most new invoices are then
+        # rejected as "not processed" without a SQLite query. It is saved at the end of each run and
+        # reused while the store is unchanged; building it reads every stored number.
+        invoice_bloom = None
+        invoice_bloom_path = os.path.join(csv_directory_path, INVOICE_BLOOM_FILENAME)
+        if os.getenv('INVOICE_BLOOM_FILTER', '0') == '1':
+            invoice_bloom = load_or_build_invoice_bloom(invoice_db, invoice_bloom_path)
+        invoice_log_writer = InvoiceLogWriter(invoice_db, int(os.getenv('INVOICE_LOG_COMMIT_EVERY', '50')), invoice_bloom,
+                                              audit_log_path=audit_log_path)
+        ensure_month_dir.cache_clear() # Folders may have been moved or removed since a previous run in this process
+
+        # Pairs uploading at the same moment share one /apply request (1 disables)
+        apply_batch_pairs = int(os.getenv('GRIST_APPLY_BATCH_PAIRS', str(max_workers)))
+        apply_batcher = ApplyBatcher(uploader, apply_batch_pairs) if apply_batch_pairs > 1 else None
+
+        # Pairs are independent and bound by Grist round trips, so process them concurrently
+        pair_worker = functools.partial(
+            process_pair,
+            uploader=uploader,
+            header_table_id=header_table_id,
+            items_table_id=items_table_id,
+            header_lookup=header_lookup,
+            items_lookup=items_lookup,
+            success_dir_path=success_dir_path,
+            month_year_str=datetime.now().strftime("%b-%y"), # Success subfolder for this run, e.g. Apr-25
+            rejected_dir_path=rejected_dir_path,
+            invoice_db=invoice_db,
+            invoice_bloom=invoice_bloom,
+            invoice_log_writer=invoice_log_writer,
+            reserved_invoice_numbers=set(), # Invoices being uploaded by this run
+            invoice_lock=threading.Lock(),
+            log_file_name=log_file_name,
+            apply_batcher=apply_batcher
         )
-    except Exception as e:
-        # Errors during log loading/creation are logged within the functions
-        logging.critical(f"Failed to load or create the processed invoice log '{processed_log_path}'. Cannot proceed safely with duplicate checks. Exiting. Error: {e}")
-        print(f"CRITICAL: Failed to initialize invoice log. Exiting.")
-        return
 
+        def run_pair(*pair):
+            # Checked as each pair starts, so a stop request only waits for the pairs in progress
+            if stop_event is not None and stop_event.is_set():
+                return 'stopped'
+            return pair_worker(*pair)
 
-    # --- Find and Pair Files ---
-    files_in_dir = os.listdir(csv_directory_path)
-    file_prefixes = set()
-    potential_files = {}
-
-    for f in files_in_dir:
-        if f.endswith('_Header.csv'):
-            prefix = f[:-len('_Header.csv')]
-            file_prefixes.add(prefix)
-            potential_files[f] = os.path.join(csv_directory_path, f)
-        elif f.endswith('_Items.csv'):
-            prefix = f[:-len('_Items.csv')]
-            file_prefixes.add(prefix)
-            potential_files[f] = os.path.join(csv_directory_path, f)
-
-    print(f"Found {len(file_prefixes)} unique file prefixes.")
-
-    # --- Process Paired Files ---
-    processed_count = 0
-    success_count = 0
-    fail_count = 0
-    duplicate_count = 0 # Add counter for duplicates
-
-    for prefix in sorted(list(file_prefixes)): # Sort for consistent processing order
-        header_filename = f"{prefix}_Header.csv"
-        items_filename = f"{prefix}_Items.csv"
-
-        header_path = potential_files.get(header_filename)
-        items_path = potential_files.get(items_filename)
-
-        # Check if BOTH files for the prefix exist in the source directory
-        if header_path and items_path and os.path.exists(header_path) and os.path.exists(items_path):
-            print(f"\n--- Processing Pair: {prefix} ---")
-            processed_count += 1
-            header_success = False
-            items_success = False
-            invoice_number = None # Initialize
-
-            # 0. Check for Duplicates using the log file
-            try:
-                invoice_number = get_invoice_number_from_csv(header_path, INVOICE_NUMBER_COLUMN_LABEL)
-                if invoice_number is None:
-                    print(f"Warning: Could not read Invoice Number from {header_filename}. Skipping this pair.")
-                    logging.warning(f"Could not read Invoice Number from {header_filename} for prefix '{prefix}'. Skipping.")
-                    fail_count += 1
-                    continue # Skip to next prefix
-
-                if invoice_number in processed_invoice_numbers:
-                    print(f"Duplicate detected: Invoice Number '{invoice_number}' from file {header_filename} already processed. Moving to Rejected folder.")
-                    duplicate_count += 1
-                    # Move both files to Rejected folder with _duplicate suffix
-                    moved_header_dup = move_and_rename_duplicate(header_path, rejected_dir_path)
-                    moved_items_dup = move_and_rename_duplicate(items_path, rejected_dir_path)
-                    if not moved_header_dup or not moved_items_dup:
-                         # Log that the move failed, files might remain in source
-                         logging.error(f"Failed to move one or both duplicate files for prefix '{prefix}' (Invoice: {invoice_number}) to Rejected folder.")
-                    # No need to increment fail_count here unless move fails? Let's count separately.
-                    continue # Skip to next prefix
-
-            except Exception as e:
-                 print(f"Error checking for duplicate invoice number in {header_filename}: {e}. Skipping this pair.")
-                 logging.error(f"Error checking duplicate for prefix '{prefix}' ({header_filename}): {e}\n{traceback.format_exc()}")
-                 fail_count += 1
-                 continue # Skip to next prefix
-
-
-            # --- If not a duplicate, proceed with upload ---
-            print(f"Invoice Number '{invoice_number}' not found in log. Proceeding with upload...")
-
-            # 1. Process Header File
-            try:
-                header_success = upload_csv_to_grist(header_path, header_table_id, uploader, header_columns_data)
-            except Exception as e:
-                if not isinstance(e, (requests.exceptions.RequestException, FileNotFoundError)):
-                     logging.error(f"Unexpected error processing header file {header_filename}: {e}\n{traceback.format_exc()}")
-                header_success = False
-
-            # 2. Process Items File (only if header was successful)
-            if header_success:
-                try:
-                    items_success = upload_csv_to_grist(items_path, items_table_id, uploader, items_columns_data)
-                except Exception as e:
-                    if not isinstance(e, (requests.exceptions.RequestException, FileNotFoundError)):
-                         logging.error(f"Unexpected error processing items file {items_filename}: {e}\n{traceback.format_exc()}")
-                    items_success = False
-            else:
-                 print(f"Skipping items file {items_filename} because header processing failed.")
-                 items_success = False
-
-            # 3. Move files and Update Log if BOTH succeeded
-            if header_success and items_success:
-                print(f"Both uploads successful for prefix '{prefix}'. Moving files...")
-                moved_header = move_and_rename_file(header_path, success_dir_path)
-                moved_items = move_and_rename_file(items_path, success_dir_path)
-                if moved_header and moved_items:
-                    success_count += 1
-                    # Add to log file and in-memory set
-                    append_invoice_to_log(processed_log_path, invoice_number)
-                    processed_invoice_numbers.add(invoice_number) # Update in-memory set
-                    print(f"Successfully processed, moved, and logged pair: {prefix} (Invoice: {invoice_number})")
-                else:
-                    fail_count += 1
-                    # CRITICAL: Uploads succeeded but move failed. Invoice is NOT logged.
-                    logging.error(f"Uploads succeeded for '{prefix}' (Invoice: {invoice_number}), but failed to move one or both files. INVOICE NOT LOGGED AS PROCESSED. Please check manually.")
-                    print(f"CRITICAL WARNING: Uploads succeeded for '{prefix}' but move failed. Invoice '{invoice_number}' was NOT logged. Manual check required.")
-            else:
-                fail_count += 1
-                print(f"Processing failed for pair '{prefix}'. Files will not be moved. Invoice '{invoice_number}' not logged. Check '{log_file_name}' for details.")
-
-        elif header_path and not items_path:
-             # Only header exists
-             # print(f"Found header file '{header_filename}' but no matching items file.")
-             pass
-        elif not header_path and items_path:
-             # Only items exists
-             # print(f"Found items file '{items_filename}' but no matching header file.")
-             pass
-        # else: both don't exist (or one/both already moved) - do nothing
-
-
-    # --- Final Summary ---
-    print("\n--- Upload Summary ---")
-    print(f"Total unique prefixes found: {len(file_prefixes)}")
-    print(f"Pairs attempted processing (both files existed): {processed_count}")
-    print(f"Pairs successfully processed and moved: {success_count}")
-    print(f"Pairs detected as duplicates and moved to Rejected: {duplicate_count}")
-    print(f"Pairs failed (upload, move, or other error): {fail_count}")
-    print(f"Check '{log_file_name}' for any error details.")
-    print("Processing complete.")
+        try:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                futures = {executor.submit(run_pair, *pair): pair[0] for pair in pairs}
+                for future in as_completed(futures):
+                    try:
+                        outcome = future.result()
+                    except Exception as e:
+                        logging.error(f"Unexpected error processing pair '{futures[future]}': {e}\n{traceback.format_exc()}")
+                        outcome = 'failed'
+                    outcomes[outcome] += 1
+        finally:
+            # Commits the last partial batch, also when interrupted (workers have all finished)
+            invoice_log_writer.close()
+            if invoice_bloom is not None:
+                save_invoice_bloom(invoice_db, invoice_bloom, invoice_bloom_path)
+            invoice_db.close()
+
+        # --- Final Summary ---
+        print("\n--- Upload Summary ---")
+        print(f"Total unique prefixes found: {prefix_count}")
+        print(f"Pairs attempted processing (both files existed): {sum(outcomes.values())}")
+        print(f"Pairs successfully processed and moved: {outcomes['success']}")
+        print(f"Pairs detected as duplicates and moved to Rejected: {outcomes['duplicate']}")
+        print(f"Pairs failed (upload, move, or other error): {outcomes['failed']}")
+        print(f"Pairs skipped (earlier .success files, invoice not recorded): {outcomes['skipped']}")
+        if outcomes['stopped']:
+            print(f"Pairs left for the next run (stop requested): {outcomes['stopped']}")
+        print(f"Check '{log_file_name}' for any error details.")
+        print("Processing complete.")
+        return outcomes
 
 
 if __name__ == "__main__":
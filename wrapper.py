@@ -1,10 +1,11 @@
 import os
-import time
-import subprocess
+import asyncio
 import signal
 import sys
+import threading
 import requests
 import logging
+import grist_uploader
 from dotenv import load_dotenv
 from logging.handlers import RotatingFileHandler
 
@@ -18,7 +19,6 @@ load_dotenv()
 UPLOAD_INTERVAL = int(os.getenv('UPLOAD_INTERVAL', 120))
 GRIST_SERVER_URL = os.getenv('GRIST_SERVER_URL', 'https://docs.getgrist.com')
 CLAUDE_SCRIPT = 'claude_InvDataEx.py'
-GRIST_UPLOADER_SCRIPT = 'grist_uploader.py'
 LOG_FILE = os.getenv('WRAPPER_LOG_FILE', 'wrapper.log')
 
 # --- Setup Rotating Logging ---
@@ -43,14 +43,24 @@ logging.basicConfig(
     handlers=[file_handler, console_handler]
 )
 
-# Global process references
-claude_process = None
-uploader_process = None
+# Global process/task references
+claude_process = None # asyncio.subprocess.Process
+uploader_task = None # asyncio.Task running grist_uploader.main in a worker thread
+uploader_stop = threading.Event() # Set at shutdown so a running upload pass starts no more pairs
+
+EXTRACTOR_RESTART_DELAY = 5 # Seconds to wait before restarting a crashed extractor
+GRIST_CHECK_DEADLINE = 6 # Hard cap in seconds on one availability check (requests' timeout is per connect/read)
+
+# Reused by every availability check so the TCP/TLS connection is kept alive between cycles
+grist_session = requests.Session()
 
 def is_grist_available():
     """Check if Grist server is reachable."""
     try:
-        response = requests.get(GRIST_SERVER_URL, timeout=5)
+        # HEAD: only the status code is needed, not the page body
+        response = grist_session.head(GRIST_SERVER_URL, timeout=5, allow_redirects=True)
+        if response.status_code == 405: # Server doesn't allow HEAD here
+            response = grist_session.get(GRIST_SERVER_URL, timeout=5)
         if response.status_code == 200:
             logging.info("✅ Grist server is available.")
             return True
@@ -61,59 +71,90 @@ def is_grist_available():
         logging.error(f"🔴 Grist server check failed: {e}")
         return False
 
-def start_claude_extractor():
+async def start_claude_extractor():
     """Start the PDF extractor script."""
     global claude_process
     logging.info(f"🚀 Starting {CLAUDE_SCRIPT}...")
-    claude_process = subprocess.Popen([sys.executable, CLAUDE_SCRIPT])
+    # On POSIX, close_fds=False lets subprocess use posix_spawn() instead of fork()+exec(), so the
+    # wrapper's memory isn't copied to start the child. Python opens files non-inheritable, so
+    # the child still only gets stdin/stdout/stderr.
+    claude_process = await asyncio.create_subprocess_exec(sys.executable, CLAUDE_SCRIPT, close_fds=(os.name == 'nt'))
+
+async def supervise_claude_extractor():
+    """Start the extractor script and restart it whenever it dies."""
+    await start_claude_extractor()
+    while True:
+        returncode = await claude_process.wait() # Wakes as soon as the process exits, no polling
+        logging.warning(f"⚠️ {CLAUDE_SCRIPT} exited unexpectedly (code {returncode}). Restarting...")
+        await asyncio.sleep(EXTRACTOR_RESTART_DELAY) # Avoid a tight loop if it keeps crashing
+        await start_claude_extractor()
+
+async def upload_once():
+    """Run one Grist upload pass in a worker thread and log its outcome."""
+    try:
+        # In-process, so each cycle skips interpreter start-up and module imports.
+        # Logging is left as configured here: uploader messages go to the wrapper log.
+        outcomes = await asyncio.to_thread(grist_uploader.main, configure_logging=False, stop_event=uploader_stop)
+    except Exception as e:
+        logging.error(f"🔴 Grist uploader failed: {e}", exc_info=True)
+        return
+    if outcomes is not None:
+        logging.info(f"✅ Grist upload finished: {outcomes['success']} uploaded, {outcomes['duplicate']} duplicates, {outcomes['failed']} failed.")
 
-def restart_claude_extractor():
-    """Restart the extractor script if it dies."""
-    global claude_process
-    if claude_process and claude_process.poll() is not None:
-        logging.warning(f"⚠️ {CLAUDE_SCRIPT} exited unexpectedly. Restarting...")
-        start_claude_extractor()
-
-def run_grist_uploader():
-    """Run the Grist uploader script once if not already running."""
-    global uploader_process
-    if uploader_process and uploader_process.poll() is None:
+async def run_grist_uploader():
+    """Run the Grist uploader once if not already running."""
+    global uploader_task
+    if uploader_task and not uploader_task.done():
         logging.info("⏳ Grist uploader is still running. Skipping this upload cycle.")
         return
 
-    logging.info(f"📤 Starting {GRIST_UPLOADER_SCRIPT}...")
-    uploader_process = subprocess.Popen([sys.executable, GRIST_UPLOADER_SCRIPT])
-
-def signal_handler(sig, frame):
-    logging.info("🛑 Received interrupt signal. Shutting down processes...")
-    if claude_process:
+    logging.info("📤 Starting Grist uploader...")
+    uploader_task = asyncio.create_task(upload_once()) # Runs alongside the upload timer, like the old subprocess
+
+async def upload_loop():
+    """Every UPLOAD_INTERVAL seconds, start an upload if Grist is reachable."""
+    loop = asyncio.get_running_loop()
+    next_cycle = loop.time() # Monotonic clock, unaffected by system clock changes
+    while True:
+        # The HTTP check blocks, so it runs in a worker thread and never stalls extractor supervision
+        try:
+            available = await asyncio.wait_for(asyncio.to_thread(is_grist_available), timeout=GRIST_CHECK_DEADLINE)
+        except asyncio.TimeoutError:
+            # The thread is left to finish on its own; this cycle just counts as unavailable
+            logging.error(f"🔴 Grist server check did not finish within {GRIST_CHECK_DEADLINE}s.")
+            available = False
+        if available:
+            await run_grist_uploader()
+        else:
+            logging.warning("⏳ Grist server not available. Skipping this upload cycle.")
+        # Sleep until the next scheduled start, so time spent on the check doesn't push cycles later;
+        # a cycle that overran its slot is not followed by catch-up cycles
+        next_cycle = max(next_cycle + UPLOAD_INTERVAL, loop.time())
+        await asyncio.sleep(next_cycle - loop.time())
+
+def terminate_processes():
+    logging.info("🛑 Shutting down processes...")
+    if claude_process and claude_process.returncode is None:
         claude_process.terminate()
-    if uploader_process:
-        uploader_process.terminate()
-    sys.exit(0)
+    # A running upload pass is a thread and cannot be killed: it finishes the pairs in progress
+    # (every Grist request has a timeout) and starts no more, and asyncio.run waits for that
+    uploader_stop.set()
 
-if __name__ == "__main__":
+async def main():
     logging.info("🌟 Starting Wrapper Script...")
     logging.info(f"Upload interval set to {UPLOAD_INTERVAL} seconds.")
 
-    # Register signal handler for Ctrl+C
-    signal.signal(signal.SIGINT, signal_handler)
+    # Ctrl+C cancels this task (asyncio.run); on POSIX a SIGTERM does the same
+    if os.name != 'nt':
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
 
-    # Start claude extractor
-    start_claude_extractor()
+    try:
+        await asyncio.gather(supervise_claude_extractor(), upload_loop())
+    finally:
+        terminate_processes()
 
+if __name__ == "__main__":
     try:
-        last_upload_time = 0
-        while True:
-            time.sleep(5)
-            restart_claude_extractor()
-
-            current_time = time.time()
-            if current_time - last_upload_time >= UPLOAD_INTERVAL:
-                if is_grist_available():
-                    run_grist_uploader()
-                else:
-                    logging.warning("⏳ Grist server not available. Skipping this upload cycle.")
-                last_upload_time = current_time
-    except KeyboardInterrupt:
-        signal_handler(None, None)
+        asyncio.run(main())
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        logging.info("🛑 Received interrupt signal. Processes stopped.")